@@ -0,0 +1,94 @@
+import io
+import logging
+from base64 import b64encode
+from hashlib import md5
+
+import db_store
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_ARTWORK_SIZE = 190 * 1024
+MAX_DIMENSION = 1000
+MIN_DIMENSION = 64
+JPEG_QUALITIES = (90, 80, 70, 60)
+SCALE_STEP = 0.75
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+
+def fit_image(data):
+
+    if len(data) <= MAX_ARTWORK_SIZE and data.startswith(JPEG_MAGIC):
+        return data
+
+    try:
+        from PIL import Image
+    except ImportError:
+        if len(data) <= MAX_ARTWORK_SIZE:
+            return data
+        logger.warning('Artwork ({}): Image is over {} KB and Pillow is not installed to shrink it'.format(
+            'Local', MAX_ARTWORK_SIZE // 1024))
+        return None
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert('RGB')
+    except OSError as e:
+        logger.warning('Artwork ({}): Could not read image: {}'.format('Local', e))
+        return None
+
+    image.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
+
+    # Cheaper to give up some quality first; only scale down once even the lowest quality does not fit
+    while min(image.size) >= MIN_DIMENSION:
+        for quality in JPEG_QUALITIES:
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True)
+            if buffer.tell() <= MAX_ARTWORK_SIZE:
+                logger.debug('Artwork ({}): Recompressed {} KB to {} KB at {}x{}, quality {}'.format(
+                    'Local', len(data) // 1024, buffer.tell() // 1024, image.width, image.height, quality))
+                return buffer.getvalue()
+        image = image.resize((int(image.width * SCALE_STEP), int(image.height * SCALE_STEP)), Image.LANCZOS)
+
+    return None
+
+
+def get_artwork(path):
+
+    if not path:
+        return None
+
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return None
+
+    source_hash = md5(data).hexdigest()
+    payload = db_store.get_artwork(source_hash)
+
+    if payload is not None:
+        metrics.inc('artwork_cache', result='hit')
+        return source_hash, payload
+
+    metrics.inc('artwork_cache', result='miss')
+    with metrics.timer('artwork_seconds'):
+        image = fit_image(data)
+
+    if image is None:
+        return None
+
+    payload = b64encode(image)
+    db_store.upsert_artwork(source_hash, payload)
+
+    return source_hash, payload
+
+
+def is_uploaded(spotifyid, source_hash):
+    return db_store.get_artwork_upload(spotifyid) == source_hash
+
+
+def record_upload(spotifyid, source_hash):
+
+    logger.debug('Cache ({}): Recording artwork upload of \'{}\''.format('Local', spotifyid))
+    db_store.upsert_artwork_upload(spotifyid, source_hash)
@@ -0,0 +1,99 @@
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from playlist_diff import PlaylistDiff  # noqa: E402
+
+
+def apply_steps(items, steps):
+
+    items = list(items)
+
+    for op, args in steps:
+        if op == 'prune':
+            # Each batch is one request, so its positions all refer to the playlist as it was before the batch
+            positions = set()
+            for item in args:
+                for position in item['positions']:
+                    assert items[position] == item['uri'], 'prune of {} at {} hit {}'.format(
+                        item['uri'], position, items[position])
+                    positions.add(position)
+            items = [x for idx, x in enumerate(items) if idx not in positions]
+        elif op == 'add':
+            items.extend(args)
+        else:
+            # Spotify moves the range to just before the item that was at insert_before
+            range_start, range_length, insert_before = args
+            assert 0 <= range_start and range_start + range_length <= len(items) and 0 <= insert_before <= len(items), \
+                'reorder {} is out of range for {} items'.format(args, len(items))
+            block = items[range_start:range_start + range_length]
+            del items[range_start:range_start + range_length]
+            if insert_before > range_start:
+                insert_before = insert_before - range_length
+            items[insert_before:insert_before] = block
+
+    return items
+
+
+def make_case(rng, max_size):
+
+    # A small pool of IDs makes duplicates, partial overlaps and empty sides common
+    pool = ['t{}'.format(x) for x in range(rng.randint(1, max(max_size // 2, 1)))]
+    remote = [rng.choice(pool) for _ in range(rng.randint(0, max_size))]
+    local = [rng.choice(pool) for _ in range(rng.randint(0, max_size))]
+
+    if rng.random() < 0.5:
+        # Mostly a shuffle of what is already there, like a reordered or lightly edited playlist
+        local = [x for x in remote if rng.random() > 0.1] + rng.sample(pool, rng.randint(0, min(len(pool), 2)))
+        rng.shuffle(local)
+
+    return local, remote
+
+
+def check(trials, max_size, seed):
+
+    rng = random.Random(seed)
+
+    for trial in range(trials):
+        local, remote = make_case(rng, max_size)
+        diff = PlaylistDiff(local, remote)
+        # Batches of 3 as well, so multi-request prunes and adds are exercised on small playlists too
+        small_steps = [['prune', x] for x in diff.get_removal_batches(length=3)] + \
+            [['add', x] for x in diff.get_addition_batches(length=3)] + \
+            [['reorder', list(x)] for x in diff.moves]
+
+        for steps in (diff.get_steps(), small_steps):
+            try:
+                result = apply_steps(remote, steps)
+            except AssertionError as e:
+                return trial, local, remote, str(e)
+            if result != local:
+                return trial, local, remote, 'ended as {}'.format(result)
+
+    return None
+
+
+def main_cli():
+
+    parser = argparse.ArgumentParser(description='Check that synced steps turn random remote playlists into the '
+                                                 'local order, using Spotify\'s prune, add and reorder semantics.')
+    parser.add_argument('--trials', type=int, default=5000, help='Number of random playlists.')
+    parser.add_argument('--maxsize', type=int, default=40, help='Largest playlist to generate.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    failure = check(args.trials, args.maxsize, args.seed)
+
+    if failure is not None:
+        trial, local, remote, reason = failure
+        print('Trial {} failed: {}\n  remote: {}\n  local:  {}'.format(trial, reason, remote, local))
+        sys.exit(1)
+
+    print('{} trials passed'.format(args.trials))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,314 @@
+import json
+import random
+import re
+import string
+import time
+from collections import Counter
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+BASE62 = string.digits + string.ascii_letters
+FIELD_RE = re.compile(r'(\w+):"([^"]*)"')
+
+
+def get_fake_id(value):
+
+    number = int(md5(value.encode()).hexdigest(), 16)
+    chars = []
+    for _ in range(22):
+        number, rem = divmod(number, 62)
+        chars.append(BASE62[rem])
+
+    return ''.join(chars)
+
+
+def get_phase(method, path):
+
+    if path.startswith('/api/token'):
+        return 'auth'
+    if path.startswith('/ws/2/'):
+        return 'mbz'
+    if path.startswith('/v1/search'):
+        return 'search'
+    if path.rstrip('/') == '/v1/tracks':
+        return 'tracks'
+    if path.endswith('/images'):
+        return 'cover'
+    if method == 'GET':
+        return 'playlist_read'
+
+    return 'playlist_write'
+
+
+class FakeState:
+
+    def __init__(self, latency=0.0, miss_rate=0.1, alt_hit_rate=0.5, throttle_every=0, retry_after=1):
+        self.latency = latency
+        self.miss_rate = miss_rate
+        self.alt_hit_rate = alt_hit_rate
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.playlists = {}
+        self.snapshots = Counter()
+        self.track_status = {}
+        self.calls = Counter()
+        self.throttled = 0
+        self.lock = Lock()
+
+    def perturb(self, fraction=0.1, seed=0):
+
+        rng = random.Random(seed)
+
+        with self.lock:
+            for playlist_id, items in self.playlists.items():
+                count = max(int(len(items) * fraction), 1) if items else 0
+                for _ in range(count):
+                    items.insert(rng.randrange(len(items)), items.pop(rng.randrange(len(items))))
+                for _ in range(count // 2):
+                    items.pop(rng.randrange(len(items)))
+                items.extend(get_fake_id('{}-extra-{}'.format(playlist_id, x)) for x in range(count // 2))
+                self.snapshots[playlist_id] = self.snapshots[playlist_id] + 1
+
+    def decay(self, trackids, fraction=0.02, seed=0):
+
+        rng = random.Random(seed)
+        statuses = ('missing', 'unplayable', 'relinked')
+
+        with self.lock:
+            for idx, trackid in enumerate(rng.sample(sorted(trackids), int(len(trackids) * fraction))):
+                self.track_status[trackid] = statuses[idx % len(statuses)]
+
+    def get_calls(self):
+        with self.lock:
+            return Counter(self.calls)
+
+    def is_miss(self, query, rate):
+        return int(md5(query.encode()).hexdigest()[:8], 16) / 0xffffffff < rate
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_xml(self, body):
+
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def handle_request(self, method):
+
+        url = urlparse(self.path)
+        params = {key: value[0] for key, value in parse_qs(url.query).items()}
+        body = self.read_body()
+        phase = get_phase(method, url.path)
+        state = self.state
+
+        with state.lock:
+            state.calls[phase] = state.calls[phase] + 1
+            throttle = phase == 'search' and state.throttle_every and \
+                state.calls[phase] % state.throttle_every == 0
+            if throttle:
+                state.throttled = state.throttled + 1
+
+        if state.latency:
+            time.sleep(state.latency)
+
+        if throttle:
+            return self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                                  headers={'Retry-After': str(state.retry_after)})
+
+        if phase == 'auth':
+            return self.send_json(200, {'access_token': 'fake', 'token_type': 'Bearer', 'expires_in': 3600})
+        if phase == 'mbz':
+            return self.handle_mbz(params)
+        if phase == 'search':
+            return self.handle_search(params)
+        if phase == 'tracks':
+            return self.handle_tracks(params)
+
+        parts = url.path.strip('/').split('/')
+        playlist_id = parts[2]
+
+        if phase == 'cover':
+            return self.send_json(202, {})
+        if method == 'GET' and len(parts) == 3:
+            return self.send_json(200, {'snapshot_id': self.get_snapshot(playlist_id)})
+        if method == 'GET':
+            return self.handle_items(playlist_id, params)
+
+        return self.handle_mutation(method, playlist_id, json.loads(body or b'{}'))
+
+    def handle_search(self, params):
+
+        query = params.get('q', '')
+        fields = dict(FIELD_RE.findall(query))
+        title = fields.get('track', query.strip('"'))
+        artist = fields.get('artist', '')
+        canonical = artist[len('Romanised '):] if artist.startswith('Romanised ') else artist
+        key = '{}|{}'.format(title, canonical).casefold()
+
+        # Catalogue entries under a romanised name only turn up once the query uses that name
+        if canonical != artist:
+            found = not self.state.is_miss(key, self.state.miss_rate) or \
+                not self.state.is_miss('alt|' + key, 1 - self.state.alt_hit_rate)
+        else:
+            found = artist != '' and not self.state.is_miss(key, self.state.miss_rate)
+
+        items = [{'id': get_fake_id(key + '-live'), 'name': title + ' (Live)', 'duration_ms': 225000,
+                  'artists': [{'name': artist or 'Various Artists'}], 'album': {'name': 'Live at the Fake Hall'}}]
+        if found:
+            items.append({'id': get_fake_id(key), 'name': title, 'duration_ms': 180000,
+                          'artists': [{'name': artist}], 'album': {'name': 'Fake Album'}})
+
+            # Tracks taken down since the last sync come back as a re-release; unplayable ones are still listed
+            # next to it, and only a search in a market shows they cannot be played
+            status = self.state.track_status.get(items[-1]['id'])
+            reissue = dict(items[-1], id=get_fake_id(items[-1]['id'] + '-reissue'))
+            if status == 'missing':
+                items[-1] = reissue
+            elif status == 'unplayable':
+                if 'market' in params:
+                    items[-1]['is_playable'] = False
+                    reissue['is_playable'] = True
+                items.append(reissue)
+
+        return self.send_json(200, {'tracks': {'items': items, 'total': len(items)}})
+
+    def handle_tracks(self, params):
+
+        tracks = []
+
+        for trackid in params.get('ids', '').split(','):
+            status = self.state.track_status.get(trackid)
+            if status == 'missing':
+                tracks.append(None)
+            elif status == 'relinked':
+                tracks.append({'id': get_fake_id(trackid + '-relinked'), 'is_playable': True,
+                               'linked_from': {'id': trackid}})
+            else:
+                tracks.append({'id': trackid, 'is_playable': status != 'unplayable'})
+
+        return self.send_json(200, {'tracks': tracks})
+
+    def handle_mbz(self, params):
+
+        name = escape(params.get('query', '').split(':', 1)[-1].strip('()" '))
+        return self.send_xml('<?xml version="1.0" encoding="UTF-8"?>'
+                             '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#">'
+                             '<artist-list count="1" offset="0"><artist id="{}"><name>{}</name>'
+                             '<sort-name>Romanised {}</sort-name></artist></artist-list></metadata>'
+                             .format(get_fake_id(name), name, name))
+
+    def get_snapshot(self, playlist_id):
+        return 'snapshot-{}'.format(self.state.snapshots[playlist_id])
+
+    def handle_items(self, playlist_id, params):
+
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+
+        with self.state.lock:
+            items = self.state.playlists.setdefault(playlist_id, [])
+            page = items[offset:offset + limit]
+            total = len(items)
+
+        return self.send_json(200, {'items': [{'track': {'id': x}} for x in page], 'total': total,
+                                    'offset': offset, 'limit': limit})
+
+    def handle_mutation(self, method, playlist_id, payload):
+
+        with self.state.lock:
+            items = self.state.playlists.setdefault(playlist_id, [])
+
+            if method == 'POST':
+                items.extend(x.split(':')[-1] for x in payload)
+            elif method == 'DELETE':
+                positions = set()
+                for item in payload['items']:
+                    trackid = item['uri'].split(':')[-1]
+                    if 'positions' in item:
+                        positions.update(item['positions'])
+                    else:
+                        positions.update(idx for idx, x in enumerate(items) if x == trackid)
+                items[:] = [x for idx, x in enumerate(items) if idx not in positions]
+            elif 'range_start' in payload:
+                start = payload['range_start']
+                length = payload.get('range_length', 1)
+                insert_before = payload['insert_before']
+                block = items[start:start + length]
+                del items[start:start + length]
+                if insert_before > start:
+                    insert_before = insert_before - length
+                items[insert_before:insert_before] = block
+            else:
+                items[:] = [x.split(':')[-1] for x in payload.get('uris', [])]
+
+            self.state.snapshots[playlist_id] = self.state.snapshots[playlist_id] + 1
+
+        return self.send_json(200 if method != 'POST' else 201, {'snapshot_id': self.get_snapshot(playlist_id)})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class FakeServer:
+
+    def __init__(self, state=None, host='127.0.0.1', port=0):
+        self.state = state if state is not None else FakeState()
+        handler = type('BoundFakeHandler', (FakeHandler,), {'state': self.state})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def netloc(self):
+        return '{}:{}'.format(*self.httpd.server_address[:2])
+
+    @property
+    def url(self):
+        return 'http://{}'.format(self.netloc)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
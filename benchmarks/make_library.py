@@ -0,0 +1,78 @@
+import argparse
+import os
+import random
+import struct
+
+from mutagen.flac import FLAC
+
+# Minimal STREAMINFO block: 4096-sample blocks, 44.1 kHz, stereo, 16-bit, 180 seconds
+STREAMINFO = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + \
+    bytes([0x0a, 0xc4, 0x42, 0xf0, 0x00, 0x79, 0x1f, 0xd0]) + b'\x00' * 16
+
+
+def write_stub(path, title, artist, album):
+
+    with open(path, 'wb') as fp:
+        fp.write(b'fLaC' + bytes([0x80]) + len(STREAMINFO).to_bytes(3, 'big') + STREAMINFO)
+
+    audio = FLAC(path)
+    audio['TITLE'] = title
+    audio['ARTIST'] = artist
+    audio['ALBUM'] = album
+    audio['ALBUMARTIST'] = artist
+    audio.save()
+
+
+def make_library(root, tracks=1000, playlists=10, playlist_size=200, artists=100, albums=200, seed=0):
+
+    rng = random.Random(seed)
+    music_dir = os.path.join(root, 'music')
+    playlist_dir = os.path.join(root, 'playlists')
+    os.makedirs(music_dir, exist_ok=True)
+    os.makedirs(playlist_dir, exist_ok=True)
+
+    songs = []
+    for idx in range(tracks):
+        path = os.path.join(music_dir, '{:06d}.flac'.format(idx))
+        artist = 'Artist {}'.format(rng.randrange(artists))
+        title = 'Song {}'.format(idx)
+        if not os.path.isfile(path):
+            write_stub(path, title, artist, 'Album {}'.format(rng.randrange(albums)))
+        songs.append((path, artist, title))
+
+    for idx in range(playlists):
+        with open(os.path.join(playlist_dir, 'Playlist {:03d}.m3u8'.format(idx)), 'w', encoding='utf-8') as fp:
+            fp.write('#EXTM3U\n')
+            for path, artist, title in rng.sample(songs, min(playlist_size, len(songs))):
+                fp.write('#EXTINF:180,{} - {}\n{}\n'.format(artist, title, path))
+
+    return playlist_dir
+
+
+def make_artwork(artwork_dir, names, size=1200, seed=0):
+
+    # Noise barely compresses, so these are well over the upload limit and have to be shrunk
+    from PIL import Image
+
+    os.makedirs(artwork_dir, exist_ok=True)
+    for idx, name in enumerate(names):
+        Image.frombytes('RGB', (size, size), random.Random(seed + idx).randbytes(size * size * 3)) \
+            .save(os.path.join(artwork_dir, '{}.jpg'.format(name)), quality=95)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic tagged library with M3U8 playlists.')
+    parser.add_argument('root', type=str, help='Directory to create the library in.')
+    parser.add_argument('--tracks', type=int, default=1000, help='Number of audio stubs.')
+    parser.add_argument('--playlists', type=int, default=10, help='Number of playlists.')
+    parser.add_argument('--playlistsize', type=int, default=200, help='Tracks per playlist.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+
+    print(make_library(args.root, tracks=args.tracks, playlists=args.playlists, playlist_size=args.playlistsize,
+                       seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
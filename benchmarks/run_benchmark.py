@@ -0,0 +1,270 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from threading import Event, Lock, Thread
+from urllib.parse import urlparse
+
+import musicbrainzngs
+import spotipy
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client_registry  # noqa: E402
+import db_store  # noqa: E402
+import library_plan  # noqa: E402
+import local_playlist_manager  # noqa: E402
+import main  # noqa: E402
+import mbz_utils  # noqa: E402
+import metrics  # noqa: E402
+import resolution_cache  # noqa: E402
+import spotify_playlist_manager  # noqa: E402
+import tag_index  # noqa: E402
+from dicttypes import Playlist  # noqa: E402
+from fake_api import FakeServer, FakeState, get_fake_id, get_phase  # noqa: E402
+from make_library import make_artwork, make_library  # noqa: E402
+
+PHASES = (('scan', library_plan, 'scan_tags'),
+          ('resolve', local_playlist_manager, 'populate_spotify_ids'),
+          ('sync', spotify_playlist_manager, 'process_playlist'),
+          ('verify', main, 'verify_library'))
+
+
+def get_rss():
+
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PhaseRecorder:
+
+    def __init__(self, state):
+        self.state = state
+        self.active = Counter()
+        self.wall = defaultdict(float)
+        self.calls = defaultdict(Counter)
+        self.peak_rss = defaultdict(int)
+        self.lock = Lock()
+        self.stopped = Event()
+        self.sampler = Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(0.005):
+            rss = get_rss()
+            with self.lock:
+                for phase in +self.active:
+                    self.peak_rss[phase] = max(self.peak_rss[phase], rss)
+
+    def get_phase(self):
+        return (metrics.get_scope() or {}).get('phase', 'other')
+
+    def count_call(self, endpoint):
+        with self.lock:
+            self.calls[self.get_phase()][endpoint] += 1
+
+    def count_response(self, response, *args, **kwargs):
+        self.count_call(get_phase(response.request.method, urlparse(response.url).path))
+
+    def wrap(self, phase, func):
+
+        # Playlists run concurrently, so calls are attributed through the calling thread's metrics scope, which
+        # metrics.bind already carries into the search and verify workers
+        def wrapper(*args, **kwargs):
+            with self.lock:
+                self.active[phase] += 1
+            start = time.perf_counter()
+            try:
+                with metrics.scope(**dict(metrics.get_scope() or {}, phase=phase)):
+                    return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.wall[phase] = self.wall[phase] + time.perf_counter() - start
+                    self.peak_rss[phase] = max(self.peak_rss[phase], get_rss())
+                    self.active[phase] -= 1
+
+        return wrapper
+
+    def count_mbz(self, func):
+
+        # musicbrainzngs does not use the shared session, and every lookup is a single search
+        def wrapper(*args, **kwargs):
+            self.count_call('mbz')
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def run(self, func, *args, **kwargs):
+
+        originals = [(module, name, getattr(module, name)) for _, module, name in PHASES] + \
+            [(mbz_utils, 'query_romanised_name', mbz_utils.query_romanised_name)]
+        for (phase, module, name), (_, _, original) in zip(PHASES, originals):
+            setattr(module, name, self.wrap(phase, original))
+        mbz_utils.query_romanised_name = self.count_mbz(mbz_utils.query_romanised_name)
+
+        hooks = client_registry.get_session().hooks['response']
+        hooks.append(self.count_response)
+        calls = self.state.get_calls()
+
+        self.sampler.start()
+        try:
+            self.wrap('total', func)(*args, **kwargs)
+        finally:
+            self.stopped.set()
+            self.sampler.join()
+            hooks.remove(self.count_response)
+            # Totals come from the stand-in itself, so they hold regardless of attribution
+            self.calls['total'] = self.state.get_calls() - calls
+            for module, name, original in originals:
+                setattr(module, name, original)
+
+    def report(self):
+        return {phase: {'wall': round(self.wall[phase], 4), 'calls': dict(self.calls[phase]),
+                        'peak_rss_mib': round(self.peak_rss[phase] / 2 ** 20, 1)}
+                for phase in [x[0] for x in PHASES] + ['total']}
+
+
+def write_config(server):
+
+    with open('config.yaml', 'w') as fp:
+        yaml.safe_dump({
+            'spotify_creds': {'client_id': 'bench', 'client_secret': 'bench', 'redirect_uri': 'http://localhost/'},
+            'mbz_creds': {'useragent': {'app': 'SpotiM3UBench', 'version': '0.1', 'contact': 'bench@localhost'},
+                          'rate_limit': {'limit_or_interval': 1.0, 'new_requests': 1}}
+        }, fp)
+
+    musicbrainzngs.set_hostname(server.netloc, use_https=False)
+
+
+def create_fake_client(server):
+
+    sp = spotipy.Spotify(auth='fake', requests_session=client_registry.get_session())
+    sp.prefix = '{}/v1/'.format(server.url)
+
+    return sp
+
+
+def reset_process_state(server):
+
+    db_store.close_connection()
+    client_registry.reset()
+    resolution_cache._cache = None
+    tag_index._index = None
+    mbz_utils._romanised.clear()
+
+    for name in ('spotify', 'spotify-user'):
+        client_registry.get_client(name, lambda: create_fake_client(server))
+
+
+def map_playlists(playlist_dir):
+
+    playlists = [Playlist(os.path.join(playlist_dir, x)) for x in sorted(os.listdir(playlist_dir))]
+    db_store.upsert_playlists([(x.get_name(), x.get_name(), get_fake_id(x.get_name()), x['spotifypicture'])
+                               for x in playlists])
+
+
+def run_benchmark(args):
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='spotim3u-bench-')
+    playlist_dir = make_library(os.path.join(workdir, 'library'), tracks=args.tracks, playlists=args.playlists,
+                                playlist_size=args.playlistsize)
+    run_dir = os.path.join(workdir, 'run')
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+
+    state = FakeState(latency=args.latency, miss_rate=args.missrate, throttle_every=args.throttleevery)
+    results = {}
+
+    with FakeServer(state) as server:
+        write_config(server)
+        reset_process_state(server)
+        map_playlists(playlist_dir)
+        if args.updateart:
+            make_artwork('artwork', [os.path.splitext(x)[0] for x in sorted(os.listdir(playlist_dir))])
+
+        for run in ('cold', 'perturbed', 'steady') + (('verify',) if args.verify else ()):
+            if run == 'perturbed':
+                state.perturb(seed=args.tracks)
+            if run == 'verify':
+                state.decay(db_store.get_stored_spotifyids(), fraction=args.decay, seed=args.tracks)
+            reset_process_state(server)
+            metrics.reset()
+
+            recorder = PhaseRecorder(state)
+            recorder.run(main.playlist_iter, playlist_dir, workers=args.workers, scan_workers=args.scanworkers,
+                         local_workers=args.localworkers, sync_workers=args.syncworkers, verify=run == 'verify',
+                         update_art=args.updateart)
+            results[run] = recorder.report()
+            results[run]['metrics'] = metrics.to_dict()
+
+        results['throttled'] = state.throttled
+
+    db_store.close_connection()
+
+    return results
+
+
+def print_report(results):
+
+    print('{:<10} {:<8} {:>9} {:>10} {:>14}  {}'.format('run', 'phase', 'wall (s)', 'API calls', 'peak RSS (MiB)',
+                                                       'calls by endpoint'))
+    for run, phases in results.items():
+        if not isinstance(phases, dict):
+            continue
+        for phase, stats in phases.items():
+            if phase == 'metrics':
+                continue
+            print('{:<10} {:<8} {:>9.3f} {:>10} {:>14.1f}  {}'.format(
+                run, phase, stats['wall'], sum(stats['calls'].values()), stats['peak_rss_mib'],
+                ' '.join('{}={}'.format(*x) for x in sorted(stats['calls'].items()))))
+    print('429 responses injected: {}'.format(results['throttled']))
+
+
+def main_cli():
+
+    parser = argparse.ArgumentParser(description='Benchmark playlist_iter against an offline Spotify/MBZ stand-in.')
+    parser.add_argument('--tracks', type=int, default=2000, help='Number of audio stubs in the library.')
+    parser.add_argument('--playlists', type=int, default=20, help='Number of playlists.')
+    parser.add_argument('--playlistsize', type=int, default=300, help='Tracks per playlist.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every fake API response.')
+    parser.add_argument('--missrate', type=float, default=0.05, help='Fraction of primary searches that miss.')
+    parser.add_argument('--throttleevery', type=int, default=0, help='Answer every Nth search with a 429.')
+    parser.add_argument('--workers', type=int, default=main.DEFAULT_WORKERS, help='Concurrent Spotify searches.')
+    parser.add_argument('--scanworkers', type=int, default=main.DEFAULT_SCAN_WORKERS, help='Concurrent tag readers.')
+    parser.add_argument('--localworkers', type=int, default=main.DEFAULT_LOCAL_WORKERS,
+                        help='Playlists read and resolved concurrently.')
+    parser.add_argument('--syncworkers', type=int, default=main.DEFAULT_SYNC_WORKERS,
+                        help='Playlists synced concurrently.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Add a run that takes down some stored tracks and syncs with --verify.')
+    parser.add_argument('--decay', type=float, default=0.02,
+                        help='Fraction of stored tracks made missing, unplayable or relinked for --verify.')
+    parser.add_argument('--updateart', action='store_true',
+                        help='Give every playlist oversized artwork and sync with --updateart (needs Pillow).')
+    parser.add_argument('--workdir', type=str, help='Directory for the library and database (default: temp dir).')
+    parser.add_argument('--json', type=str, help='Also write the results to this JSON file.')
+    parser.add_argument('--loglevel', type=str, default='warning', help='Set the logging level.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper(), logging.WARNING))
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    results = run_benchmark(args)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_store  # noqa: E402
+import main  # noqa: E402
+from fake_api import FakeServer, FakeState  # noqa: E402
+from make_library import make_library  # noqa: E402
+from run_benchmark import map_playlists, reset_process_state, write_config  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('pandas', 'numpy', 'spotipy', 'requests', 'yaml', 'musicbrainzngs', 'mutagen')
+
+
+def get_commands(playlist_dir):
+
+    script = os.path.join(REPO_DIR, 'main.py')
+
+    return {'import': [sys.executable, '-c', 'import main'],
+            'help': [sys.executable, script, '--help'],
+            'noop': [sys.executable, script, playlist_dir, '--loglevel', 'warning']}
+
+
+def time_command(command, env, repeat):
+
+    walls = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        walls.append(time.perf_counter() - start)
+
+    return walls
+
+
+def get_loaded_modules(command, env):
+
+    result = subprocess.run([command[0], '-X', 'importtime'] + command[1:], env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, check=True)
+    names = {x.rsplit('|', 1)[-1].strip() for x in result.stderr.splitlines() if x.startswith('import time:')}
+
+    return [x for x in HEAVY_MODULES if x in names]
+
+
+def run_benchmark(args):
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='spotim3u-startup-')
+    playlist_dir = make_library(os.path.join(workdir, 'library'), tracks=args.tracks, playlists=args.playlists,
+                                playlist_size=args.playlistsize)
+    run_dir = os.path.join(workdir, 'run')
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+
+    # One real sync against the stand-in records the playlist files, so the CLI runs below have nothing to do
+    with FakeServer(FakeState()) as server:
+        write_config(server)
+        reset_process_state(server)
+        map_playlists(playlist_dir)
+        main.playlist_iter(playlist_dir, skip_unchanged=True)
+    db_store.close_connection()
+
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    results = {}
+
+    for name, command in get_commands(playlist_dir).items():
+        walls = time_command(command, env, args.repeat)
+        results[name] = {'median': statistics.median(walls), 'min': min(walls),
+                         'heavy_modules': get_loaded_modules(command, env)}
+
+    return results
+
+
+def print_report(results):
+
+    print('{:<8} {:>10} {:>10}  {}'.format('command', 'median (s)', 'min (s)', 'heavy modules loaded'))
+    for name, stats in results.items():
+        print('{:<8} {:>10.3f} {:>10.3f}  {}'.format(name, stats['median'], stats['min'],
+                                                     ' '.join(stats['heavy_modules']) or '-'))
+
+
+def main_cli():
+
+    parser = argparse.ArgumentParser(description='Benchmark SpotiM3U startup and the no-op path of an unchanged library.')
+    parser.add_argument('--tracks', type=int, default=2000, help='Number of audio stubs in the library.')
+    parser.add_argument('--playlists', type=int, default=20, help='Number of playlists.')
+    parser.add_argument('--playlistsize', type=int, default=300, help='Tracks per playlist.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per command.')
+    parser.add_argument('--workdir', type=str, help='Directory for the library and database (default: temp dir).')
+    parser.add_argument('--json', type=str, help='Also write the results to this JSON file.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    results = run_benchmark(args)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,86 @@
+import logging
+import os
+from threading import RLock
+from urllib.parse import urlparse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+POOL_MAXSIZE = 32
+HTTP_RETRIES = 3
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_BACKOFF = 0.3
+
+_lock = RLock()
+_configs = {}
+_session = None
+_clients = {}
+
+
+def load_config(config_file='config.yaml'):
+
+    with _lock:
+        if config_file not in _configs:
+            if not os.path.isfile(config_file):
+                return None
+            import yaml
+            logger.debug('SpotiM3U ({}): Reading \'{}\''.format('Func', config_file))
+            with open(config_file, 'r') as fp:
+                _configs[config_file] = yaml.safe_load(fp)
+
+        return _configs[config_file]
+
+
+def get_session():
+
+    global _session
+
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3 import Retry
+            logger.debug('SpotiM3U ({}): Opening pooled HTTP session'.format('Func'))
+            _session = requests.Session()
+            # Spotipy skips its own retry setup when handed a session, so transient 5xx are retried here instead;
+            # 429s are left to spotify_call, which backs off every worker together. The last 5xx is returned rather
+            # than raised, since spotipy would report an exhausted retry as a 429
+            retry = Retry(total=HTTP_RETRIES, connect=None, read=False, status=HTTP_RETRIES,
+                          allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']), backoff_factor=RETRY_BACKOFF,
+                          status_forcelist=RETRY_STATUSES, respect_retry_after_header=False, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session.hooks['response'].append(count_response)
+
+        return _session
+
+
+def count_response(response, *args, **kwargs):
+    metrics.inc('http_requests', host=urlparse(response.url).hostname, status=response.status_code)
+    metrics.attribute('playlist_http_requests')
+
+
+def get_client(name, factory):
+
+    with _lock:
+        if name not in _clients:
+            client = factory()
+            if client is None:
+                return None
+            _clients[name] = client
+
+        return _clients[name]
+
+
+def reset():
+
+    global _session
+
+    with _lock:
+        _configs.clear()
+        _clients.clear()
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,442 @@
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from threading import RLock
+
+logger = logging.getLogger(__name__)
+
+STORE_DB = 'db/{}.db'.format('spotim3u')
+CSV_DIR = 'db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS playlists (
+    name TEXT PRIMARY KEY,
+    spotifyname TEXT NOT NULL,
+    spotifyid TEXT NOT NULL DEFAULT 'NIL',
+    spotifypicture TEXT
+);
+CREATE INDEX IF NOT EXISTS playlists_spotifyid ON playlists (spotifyid);
+CREATE TABLE IF NOT EXISTS tracks (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    albumartist TEXT
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    track_id TEXT NOT NULL,
+    spotifyid TEXT NOT NULL DEFAULT 'NIL',
+    whitelist INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (playlist, position)
+);
+CREATE INDEX IF NOT EXISTS playlist_tracks_track ON playlist_tracks (playlist, track_id);
+CREATE INDEX IF NOT EXISTS playlist_tracks_spotifyid ON playlist_tracks (spotifyid);
+CREATE TABLE IF NOT EXISTS resolutions (
+    key TEXT PRIMARY KEY,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    spotifyid TEXT NOT NULL,
+    updated INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resolutions_spotifyid ON resolutions (spotifyid);
+CREATE TABLE IF NOT EXISTS tags (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    albumartist TEXT,
+    length REAL
+);
+CREATE TABLE IF NOT EXISTS artist_names (
+    key TEXT PRIMARY KEY,
+    sort_name TEXT,
+    source TEXT NOT NULL,
+    updated INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    spotifyid TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artwork (
+    source_hash TEXT PRIMARY KEY,
+    payload BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS artwork_uploads (
+    spotifyid TEXT PRIMARY KEY,
+    source_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS playlist_files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    settings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_journal (
+    spotifyid TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL,
+    steps TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+TRACK_COLUMNS = ('title', 'artist', 'album', 'albumartist')
+TAG_COLUMNS = TRACK_COLUMNS + ('length',)
+
+_lock = RLock()
+_conn = None
+
+
+def get_connection(store_db=STORE_DB):
+
+    global _conn
+
+    with _lock:
+        if _conn is None:
+            fresh = not os.path.isfile(store_db)
+            Path(store_db).parent.mkdir(parents=True, exist_ok=True)
+
+            logger.debug('SpotiM3U ({}): Opening store \'{}\''.format('DB', store_db))
+            _conn = sqlite3.connect(store_db, check_same_thread=False)
+            _conn.execute('PRAGMA journal_mode=WAL')
+            _conn.execute('PRAGMA synchronous=NORMAL')
+            _conn.executescript(SCHEMA)
+
+            if fresh and os.path.isfile(os.path.join(CSV_DIR, 'playlist.csv')):
+                import_csv()
+
+        return _conn
+
+
+def close_connection():
+
+    global _conn
+
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+@contextmanager
+def transaction():
+
+    with _lock:
+        conn = get_connection()
+        with conn:
+            yield conn
+
+
+def query(sql, params=()):
+
+    with _lock:
+        return get_connection().execute(sql, params).fetchall()
+
+
+def none_if_nan(value):
+    return None if isinstance(value, float) and value != value else value
+
+
+# Playlists
+
+def get_playlist_row(name):
+
+    rows = query('SELECT spotifyname, spotifyid, spotifypicture FROM playlists WHERE name = ?', (name,))
+    return rows[0] if rows else None
+
+
+def get_playlist_spotifyids():
+    return dict(query('SELECT name, spotifyid FROM playlists'))
+
+
+def insert_playlists(playlist_objs):
+
+    with transaction() as conn:
+        conn.executemany('INSERT OR IGNORE INTO playlists (name, spotifyname, spotifyid, spotifypicture) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(x['name'], x['spotifyname'], x['spotifyid'], x['spotifypicture']) for x in playlist_objs])
+
+
+def upsert_playlists(rows):
+
+    with transaction() as conn:
+        conn.executemany('INSERT INTO playlists (name, spotifyname, spotifyid, spotifypicture) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT (name) DO UPDATE SET spotifyname = excluded.spotifyname, '
+                         'spotifyid = excluded.spotifyid, spotifypicture = excluded.spotifypicture', rows)
+
+
+# Playlist membership
+
+def get_playlist_tracks(name):
+
+    rows = query('SELECT track_id, spotifyid, whitelist FROM playlist_tracks WHERE playlist = ? ORDER BY position',
+                 (name,))
+    return [(track_id, spotifyid, bool(whitelist)) for track_id, spotifyid, whitelist in rows]
+
+
+def replace_playlist_tracks(name, df):
+
+    track_rows = [(track_id, *[none_if_nan(x) for x in values])
+                  for track_id, *values in zip(df.index, *[df[x] for x in TRACK_COLUMNS])]
+    member_rows = [(name, position, track_id, spotifyid, int(bool(whitelist))) for position, (track_id, spotifyid,
+                   whitelist) in enumerate(zip(df.index, df['spotifyid'], df['whitelist']))]
+
+    with transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO tracks (id, title, artist, album, albumartist) '
+                         'VALUES (?, ?, ?, ?, ?)', track_rows)
+        conn.execute('DELETE FROM playlist_tracks WHERE playlist = ?', (name,))
+        conn.executemany('INSERT INTO playlist_tracks (playlist, position, track_id, spotifyid, whitelist) '
+                         'VALUES (?, ?, ?, ?, ?)', member_rows)
+
+
+def get_stored_spotifyids():
+    return [spotifyid for spotifyid, in query('SELECT spotifyid FROM playlist_tracks WHERE spotifyid NOT IN (?, ?) '
+                                              'UNION SELECT spotifyid FROM resolutions WHERE spotifyid NOT IN (?, ?)',
+                                              ('NIL', 'NOT_AVAIL', 'NIL', 'NOT_AVAIL'))]
+
+
+def replace_playlist_spotifyids(replacements):
+
+    with transaction() as conn:
+        conn.executemany('UPDATE playlist_tracks SET spotifyid = ? WHERE spotifyid = ?',
+                         [(new if new is not None else 'NIL', old) for old, new in replacements.items()])
+
+
+def get_playlist_frame(name):
+
+    import pandas as pd
+
+    rows = query('SELECT m.track_id, t.title, t.artist, t.album, t.albumartist, m.spotifyid, m.whitelist '
+                 'FROM playlist_tracks m LEFT JOIN tracks t ON t.id = m.track_id '
+                 'WHERE m.playlist = ? ORDER BY m.position', (name,))
+    df = pd.DataFrame(rows, columns=['id', *TRACK_COLUMNS, 'spotifyid', 'whitelist']).set_index('id')
+    df['whitelist'] = df['whitelist'].astype(bool)
+
+    return df
+
+
+# Resolutions
+
+def load_resolutions():
+    return {key: {'title': title, 'artist': artist, 'album': album, 'spotifyid': spotifyid, 'updated': updated}
+            for key, title, artist, album, spotifyid, updated
+            in query('SELECT key, title, artist, album, spotifyid, updated FROM resolutions')}
+
+
+def upsert_resolutions(entries):
+
+    with transaction() as conn:
+        conn.executemany('INSERT INTO resolutions (key, title, artist, album, spotifyid, updated) '
+                         'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                         'spotifyid = excluded.spotifyid, updated = excluded.updated',
+                         [(key, none_if_nan(x['title']), none_if_nan(x['artist']), none_if_nan(x['album']),
+                           x['spotifyid'], x['updated']) for key, x in entries.items()])
+
+
+def delete_resolutions(keys):
+
+    with transaction() as conn:
+        conn.executemany('DELETE FROM resolutions WHERE key = ?', [(x,) for x in keys])
+
+
+# Tags
+
+def load_tags():
+    return {path: (mtime_ns, size, dict(zip(TAG_COLUMNS, tags)))
+            for path, mtime_ns, size, *tags
+            in query('SELECT path, mtime_ns, size, title, artist, album, albumartist, length FROM tags')}
+
+
+def upsert_tags(entries):
+
+    with transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO tags (path, mtime_ns, size, title, artist, album, albumartist, '
+                         'length) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(path, mtime_ns, size, *[none_if_nan(tags.get(x)) for x in TAG_COLUMNS])
+                          for path, (mtime_ns, size, tags) in entries.items()])
+
+
+# Artist names
+
+def get_artist_name(key):
+
+    rows = query('SELECT sort_name, source, updated FROM artist_names WHERE key = ?', (key,))
+    return {'sort_name': rows[0][0], 'source': rows[0][1], 'updated': rows[0][2]} if rows else None
+
+
+def upsert_artist_names(rows, keep_known=False):
+
+    # keep_known only fills in unknown or negative entries, so an earlier answer for a name is never replaced
+    with transaction() as conn:
+        conn.executemany('INSERT INTO artist_names (key, sort_name, source, updated) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT (key) DO UPDATE SET sort_name = excluded.sort_name, source = excluded.source, '
+                         'updated = excluded.updated' + (' WHERE artist_names.sort_name IS NULL' if keep_known else ''),
+                         rows)
+
+
+# Sync state
+
+def get_sync_state(spotifyid):
+
+    rows = query('SELECT fingerprint, snapshot_id FROM sync_state WHERE spotifyid = ?', (spotifyid,))
+    return {'fingerprint': rows[0][0], 'snapshot_id': rows[0][1]} if rows else None
+
+
+def upsert_sync_state(spotifyid, fingerprint, snapshot_id):
+
+    with transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO sync_state (spotifyid, fingerprint, snapshot_id) VALUES (?, ?, ?)',
+                     (spotifyid, fingerprint, snapshot_id))
+
+
+def get_journal(spotifyid):
+
+    rows = query('SELECT fingerprint, snapshot_id, steps, done FROM sync_journal WHERE spotifyid = ?', (spotifyid,))
+    return dict(zip(('fingerprint', 'snapshot_id', 'steps', 'done'), rows[0])) if rows else None
+
+
+def has_journals():
+    return bool(query('SELECT 1 FROM sync_journal LIMIT 1'))
+
+
+def insert_journal(spotifyid, fingerprint, snapshot_id, steps):
+
+    with transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO sync_journal (spotifyid, fingerprint, snapshot_id, steps, done) '
+                     'VALUES (?, ?, ?, ?, 0)', (spotifyid, fingerprint, snapshot_id, steps))
+
+
+def update_journal(spotifyid, snapshot_id, done):
+
+    with transaction() as conn:
+        conn.execute('UPDATE sync_journal SET snapshot_id = ?, done = ? WHERE spotifyid = ?',
+                     (snapshot_id, done, spotifyid))
+
+
+def delete_journal(spotifyid):
+
+    with transaction() as conn:
+        conn.execute('DELETE FROM sync_journal WHERE spotifyid = ?', (spotifyid,))
+
+
+# Artwork
+
+def get_artwork(source_hash):
+
+    rows = query('SELECT payload FROM artwork WHERE source_hash = ?', (source_hash,))
+    return rows[0][0] if rows else None
+
+
+def upsert_artwork(source_hash, payload):
+
+    with transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO artwork (source_hash, payload) VALUES (?, ?)', (source_hash, payload))
+
+
+def get_artwork_upload(spotifyid):
+
+    rows = query('SELECT source_hash FROM artwork_uploads WHERE spotifyid = ?', (spotifyid,))
+    return rows[0][0] if rows else None
+
+
+def upsert_artwork_upload(spotifyid, source_hash):
+
+    with transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO artwork_uploads (spotifyid, source_hash) VALUES (?, ?)',
+                     (spotifyid, source_hash))
+
+
+# Playlist files
+
+def get_playlist_files():
+    return {path: (mtime_ns, size, settings)
+            for path, mtime_ns, size, settings in query('SELECT path, mtime_ns, size, settings FROM playlist_files')}
+
+
+def upsert_playlist_files(entries):
+
+    with transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO playlist_files (path, mtime_ns, size, settings) VALUES (?, ?, ?, ?)',
+                         [(path, *entry) for path, entry in entries.items()])
+
+
+def delete_playlist_files(paths):
+
+    with transaction() as conn:
+        conn.executemany('DELETE FROM playlist_files WHERE path = ?', [(x,) for x in paths])
+
+
+def clear_playlist_files():
+
+    with transaction() as conn:
+        conn.execute('DELETE FROM playlist_files')
+
+
+# CSV import/export
+
+def get_playlist_csv(csv_dir, spotifyname, spotifyid):
+    return os.path.join(csv_dir, '{} - {}.csv'.format(spotifyname, spotifyid))
+
+
+def import_csv(csv_dir=CSV_DIR):
+
+    import pandas as pd
+
+    from resolution_cache import get_key
+
+    playlist_csv = os.path.join(csv_dir, 'playlist.csv')
+
+    if os.path.isfile(playlist_csv):
+        logger.info('SpotiM3U ({}): Importing CSVs from \'{}\''.format('DB', csv_dir))
+        playlist_df = pd.read_csv(playlist_csv, dtype=str)
+        upsert_playlists([(row.name, row.spotifyname, row.spotifyid, none_if_nan(row.spotifypicture))
+                          for row in playlist_df.itertuples(index=False)])
+
+        for row in playlist_df.itertuples(index=False):
+            playlist_db = get_playlist_csv(csv_dir, row.spotifyname, row.spotifyid)
+            if os.path.isfile(playlist_db):
+                logger.debug('SpotiM3U ({}): Importing \'{}\''.format('DB', playlist_db))
+                csv_df = pd.read_csv(playlist_db, dtype={'spotifyid': str}).set_index('id')
+                csv_df['spotifyid'] = csv_df['spotifyid'].fillna('NIL')
+                csv_df['whitelist'] = csv_df['whitelist'].fillna(True).astype(bool)
+
+                # A row reset to NIL asks for a new search, so its cached match is dropped instead of reused
+                stored = {track_id: spotifyid for track_id, spotifyid, _ in get_playlist_tracks(row.name)}
+                reset = [get_key(x.title, x.artist, x.album) for x in csv_df.itertuples()
+                         if x.spotifyid == 'NIL' and stored.get(x.Index, 'NIL') != 'NIL']
+                replace_playlist_tracks(row.name, csv_df)
+                if reset:
+                    logger.debug('SpotiM3U ({}): Dropping {} cached matches reset in \'{}\''.format(
+                        'DB', len(reset), playlist_db))
+                    delete_resolutions(reset)
+
+    # Imported edits are not visible in the M3U mtimes, so the next run must not take the no-op path
+    clear_playlist_files()
+
+
+def export_csv(csv_dir=CSV_DIR):
+
+    import pandas as pd
+
+    Path(csv_dir).mkdir(parents=True, exist_ok=True)
+    playlist_df = pd.DataFrame(query('SELECT name, spotifyname, spotifyid, spotifypicture FROM playlists '
+                                     'ORDER BY name'), columns=['name', 'spotifyname', 'spotifyid', 'spotifypicture'])
+
+    playlist_csv = os.path.join(csv_dir, 'playlist.csv')
+    logger.info('SpotiM3U ({}): Exporting CSVs to \'{}\''.format('DB', csv_dir))
+    playlist_df.to_csv(playlist_csv, encoding='utf-8-sig', index=False)
+
+    for row in playlist_df.itertuples(index=False):
+        df = get_playlist_frame(row.name)
+        if not df.empty:
+            playlist_db = get_playlist_csv(csv_dir, row.spotifyname, row.spotifyid)
+            logger.debug('SpotiM3U ({}): Exporting \'{}\''.format('DB', playlist_db))
+            df.to_csv(playlist_db, encoding='utf-8-sig')
@@ -1,29 +1,12 @@
-from base64 import b64encode
 from hashlib import md5
 import logging
 from pathlib import Path
 
-import mutagen
+from artwork_cache import get_artwork
 
 logger = logging.getLogger(__name__)
 
 
-class AudioFile(dict):
-
-    fp = None
-
-    def __init__(self, fp):
-        super().__init__()
-        self.fp = mutagen.File(fp)
-        self['title'] = tagchooser(self.fp, 'TIT2', '©nam', 'TITLE')
-        self['artist'] = tagchooser(self.fp, 'TPE1', '©ART', 'ARTIST')
-        self['album'] = tagchooser(self.fp, 'TALB', '©alb', 'ALBUM')
-        self['albumartist'] = tagchooser(self.fp, 'TPE2', 'aART', 'ALBUMARTIST')
-        self['id'] = md5('{}{}{}'.format(self['title'], self['artist'], self['album']).encode()).hexdigest()
-        self['spotifyid'] = 'NIL'
-        self['whitelist'] = True
-
-
 class Playlist(dict):
 
     def __init__(self, link):
@@ -47,15 +30,12 @@ class Playlist(dict):
 
     def get_artwork(self):
 
-        max_filesize = 190 * 1024
+        artwork = get_artwork(self['spotifypicture'])
 
-        pathobj = Path(self['spotifypicture'])
-        if pathobj.is_file() and pathobj.stat().st_size <= max_filesize:
-            with open(pathobj, 'rb') as fp:
-                return b64encode(fp.read())
+        if artwork is None:
+            logger.warning('Playlist ({}) [{}]: artwork fetching failed'.format('Local', self.get_name()))
 
-        logger.warning('Playlist ({}) [{}]: artwork fetching failed'.format('Local', self.get_name()))
-        return None
+        return artwork
 
     def set_spotifyname(self, name):
         self['spotifyname'] = name
@@ -72,6 +52,20 @@ class Playlist(dict):
         self.set_spotifypicture(spic)
 
 
+def get_track_id(title, artist, album):
+    return md5('{}{}{}'.format(title, artist, album).encode()).hexdigest()
+
+
+def read_tags(audiofile):
+    return {
+        'title': tagchooser(audiofile, 'TIT2', '©nam', 'TITLE'),
+        'artist': tagchooser(audiofile, 'TPE1', '©ART', 'ARTIST'),
+        'album': tagchooser(audiofile, 'TALB', '©alb', 'ALBUM'),
+        'albumartist': tagchooser(audiofile, 'TPE2', 'aART', 'ALBUMARTIST'),
+        'length': getattr(getattr(audiofile, 'info', None), 'length', None)
+    }
+
+
 def tagchooser(audiofile, *args):
 
     value = None
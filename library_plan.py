@@ -0,0 +1,62 @@
+import logging
+
+import metrics
+import resolution_cache
+from dicttypes import get_track_id
+from local_playlist_manager import get_entry_tags, get_scan_paths
+from m3u_reader import compile_replace, iter_playlist
+from tag_index import DEFAULT_SCAN_WORKERS, scan_tags
+
+logger = logging.getLogger(__name__)
+
+
+def read_library(playlists, replace=None):
+
+    entries = {}
+    missing = {}
+    paths = {}
+
+    for playlist in playlists:
+        missing_paths = []
+        try:
+            # Paths are interned so a file listed in many playlists is held once
+            entries[playlist] = [x._replace(path=paths.setdefault(x.path, x.path))
+                                 for x in iter_playlist(playlist, replace, missing=missing_paths)]
+            missing[playlist] = len(missing_paths)
+        except (OSError, UnicodeDecodeError) as e:
+            # Left to the playlist's own local stage, which reads it again and fails in isolation
+            logger.debug('Plan ({}): Could not read \'{}\': {}'.format('Local', playlist, e))
+
+    return entries, missing
+
+
+@metrics.timed('phase_seconds', phase='plan')
+def plan_library(playlists, replacepath, regex_flag=False, extinf=False, scan_workers=DEFAULT_SCAN_WORKERS,
+                 scan_processes=False):
+
+    entries, missing = read_library(playlists, compile_replace(replacepath, regex_flag=regex_flag))
+    paths = list(dict.fromkeys(x for y in entries.values() for x in get_scan_paths(y, extinf=extinf)))
+    scanned = scan_tags(paths, workers=scan_workers, processes=scan_processes)
+
+    tracks = set()
+    keys = set()
+    for playlist_entries in entries.values():
+        for entry in playlist_entries:
+            # Files the scan could not parse are left to the local stage of the playlists listing them
+            if entry.path not in scanned and not (extinf and entry.title is not None):
+                continue
+            tags = get_entry_tags(entry, scanned, extinf=extinf)
+            tracks.add(get_track_id(tags['title'], tags['artist'], tags['album']))
+            keys.add(resolution_cache.get_key(tags['title'], tags['artist'], tags['album']))
+
+    cached = sum(resolution_cache.lookup(x) is not None for x in keys)
+
+    metrics.inc('plan_entries', sum(len(x) for x in entries.values()))
+    metrics.inc('plan_files', len(paths))
+    metrics.inc('plan_keys', len(keys))
+    logger.info('Plan ({}): {} entries over {} playlists, {} unique files, {} unique tracks, '
+                '{} unique queries of which {} are cached'.format('Local', sum(len(x) for x in entries.values()),
+                                                                  len(entries), len(paths), len(tracks), len(keys),
+                                                                  cached))
+
+    return entries, scanned, missing
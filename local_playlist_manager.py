@@ -1,102 +1,245 @@
 import logging
-import os
-import re
+from concurrent.futures import Future
 from pathlib import Path
+from threading import Lock
 
+import numpy as np
 import pandas as pd
 
-from dicttypes import AudioFile, Playlist
-from spotify_query_manager import get_spotify_id_nullsafe
+import db_store
+import metrics
+import resolution_cache
+from dicttypes import Playlist, get_track_id
+from m3u_reader import compile_replace, iter_chunks, iter_playlist
+from spotify_query_manager import DEFAULT_WORKERS, resolve_spotify_ids
+from tag_index import DEFAULT_SCAN_WORKERS, get_tags, save_index, scan_tags
 
 logger = logging.getLogger(__name__)
 
+CATEGORICAL_COLUMNS = ('artist', 'album', 'albumartist')
+
+_inflight_lock = Lock()
+_inflight = {}
+
 
 def get_playlist(playlist_link):
 
     current_playlist = Playlist(playlist_link)
 
-    playlist_db = 'db/{}.csv'.format('playlist')
-    playlist_df = pd.read_csv(playlist_db)
-
     logger.debug('Playlist ({}) [{}]: Querying local file from the database'.format('Local',
                                                                                     current_playlist.get_name()))
-    for index, row in playlist_df.iterrows():
-        if row['name'] == current_playlist['name']:
-            current_playlist.set_spotifydetails(row['spotifyname'], row['spotifyid'], row['spotifypicture'])
-            break
+    row = db_store.get_playlist_row(current_playlist.get_name())
+    if row is not None:
+        current_playlist.set_spotifydetails(*row)
 
     return current_playlist
 
 
+def get_local_mask(df):
+    spotifyids = df['spotifyid'].to_numpy()
+    return df['whitelist'].to_numpy(dtype=bool) & (spotifyids != 'NOT_AVAIL') & (spotifyids != 'NIL')
+
+
+def get_duplicate_mask(df):
+    # Later rows resolving to an already listed Spotify ID; the first occurrence is the one that gets synced
+    mask = get_local_mask(df)
+    return pd.Series(np.where(mask, df['spotifyid'].to_numpy(), None)).duplicated().to_numpy() & mask
+
+
 def get_local_trackids(df):
     logger.debug('Playlist ({}): Filtering playlist'.format('Local'))
-    df = df.loc[(df['spotifyid'] != 'NOT_AVAIL') & (df['spotifyid'] != 'NIL') & (df['whitelist'])]
-    return df['spotifyid'].tolist()
+    spotifyids = df['spotifyid'].to_numpy()
+    return spotifyids[get_local_mask(df) & ~get_duplicate_mask(df)].tolist()
+
 
+def report_duplicates(df, name):
 
-def local_trackids_dupeexists(df):
     logger.debug('Playlist ({}): Checking dupes'.format('Local'))
-    trackids = get_local_trackids(df)
+    duplicates = np.flatnonzero(get_duplicate_mask(df))
 
-    return len(trackids) != len(set(trackids))
+    for idx in duplicates:
+        row = df.iloc[idx]
+        logger.warning('Playlist ({}) [{}]: Row {} ({} - {}) duplicates track ID {}, row skipped'.format(
+            'Local', name, idx + 1, row['artist'], row['title'], row['spotifyid']))
 
+    metrics.inc('duplicate_rows', len(duplicates))
 
-# noinspection PyTypeChecker
-def playlist_csv_manager(playlist, replacepath, force_update=False, regex_flag=False):
+    return len(duplicates)
+
+
+def lookup_spotify_id(title, artist, album, nullflag, force_update=False, miss_ttl=resolution_cache.MISS_TTL):
+
+    key = resolution_cache.get_key(title, artist, album)
+    cached = resolution_cache.lookup(key)
 
-    songs = []
+    if nullflag not in ('NIL', 'NOT_AVAIL'):
+        if cached is None:
+            resolution_cache.store(key, title, artist, album, nullflag)
+        return nullflag
 
-    with open(playlist, 'r', encoding='utf-8-sig') as fp:
-        logger.debug('Playlist ({}): Reading file \'{}\''.format('Local', playlist))
-        playlist_obj = get_playlist(playlist)
-        files = fp.readlines()
-        for file in files:
-            if regex_flag:
-                cur_file = re.sub(replacepath[0], replacepath[1], file.strip())
+    if cached is not None:
+        if cached['spotifyid'] != 'NOT_AVAIL':
+            return cached['spotifyid']
+        if not (force_update and resolution_cache.is_stale(cached, miss_ttl)):
+            return 'NOT_AVAIL'
+    elif nullflag == 'NOT_AVAIL' and not force_update:
+        return nullflag
+
+    if nullflag == 'NOT_AVAIL':
+        logger.debug('SpotiM3U ({}): Force update is enabled'.format('Pref'))
+
+    return None
+
+
+@metrics.timed('phase_seconds', phase='resolve')
+def populate_spotify_ids(df, force_update=False, miss_ttl=resolution_cache.MISS_TTL, workers=DEFAULT_WORKERS,
+                         market=None):
+
+    spotifyids = []
+    queries = {}
+    unresolved = []
+
+    for idx, row in enumerate(df[['title', 'artist', 'album', 'length', 'spotifyid']].itertuples(index=False)):
+        spotifyid = lookup_spotify_id(row.title, row.artist, row.album, row.spotifyid,
+                                      force_update=force_update, miss_ttl=miss_ttl)
+        metrics.inc('resolution_cache', result='miss' if spotifyid is None else 'hit')
+        if spotifyid is None:
+            key = resolution_cache.get_key(row.title, row.artist, row.album)
+            queries.setdefault(key, (row.title, row.artist, row.album, row.length))
+            unresolved.append((idx, key))
+            spotifyid = row.spotifyid
+        spotifyids.append(spotifyid)
+
+    # Playlists resolved concurrently share tracks; only the first one to claim a key queries it
+    owned = {}
+    shared = {}
+    with _inflight_lock:
+        for key in queries:
+            if key in _inflight:
+                shared[key] = _inflight[key]
             else:
-                cur_file = file.strip().replace(replacepath[0], replacepath[1])
-            if os.path.isfile(cur_file):
-                cur_audiofile = AudioFile(cur_file)
-                songs.append(cur_audiofile)
+                owned[key] = _inflight[key] = Future()
+
+    owned_keys = list(owned)
+    resolved = dict.fromkeys(owned_keys)
+
+    # Results are stored as they arrive and flushed in checkpoints, so an interrupted run keeps its searches
+    def checkpoint(idx, spotifyid):
+        resolved[owned_keys[idx]] = spotifyid
+        if spotifyid is not None:
+            resolution_cache.store(owned_keys[idx], *queries[owned_keys[idx]][:3], spotifyid)
+        resolution_cache.checkpoint()
+
+    try:
+        resolve_spotify_ids([queries[x] for x in owned_keys], workers=workers, callback=checkpoint, market=market)
+    finally:
+        resolution_cache.save_cache()
+        with _inflight_lock:
+            for key, future in owned.items():
+                del _inflight[key]
+                future.set_result(resolved.get(key))
+
+    resolved.update({key: future.result() for key, future in shared.items()})
 
-    df = pd.DataFrame(songs).set_index('id')
+    for idx, key in unresolved:
+        if resolved[key] is not None:
+            spotifyids[idx] = resolved[key]
 
-    Path('db').mkdir(parents=True, exist_ok=True)
-    playlist_db = 'db/{}.csv'.format(playlist_obj.get_spotifyname_id())
+    return spotifyids
 
-    if os.path.isfile(playlist_db):
-        csv_df = pd.read_csv(playlist_db).set_index('id')
-        df['spotifyid'] = csv_df['spotifyid']
-        df['whitelist'] = csv_df['whitelist']
-        df = csv_df.reset_index().merge(df.reset_index(), how='right').set_index('id')
-        df['spotifyid'].fillna('NIL', inplace=True)
-        df['whitelist'].fillna(True, inplace=True)
+
+def get_entry_tags(entry, scanned, extinf=False):
+
+    if extinf and entry.title is not None:
+        return {'title': entry.title, 'artist': entry.artist, 'album': None, 'albumartist': None,
+                'length': entry.duration if entry.duration is not None and entry.duration > 0 else None}
+
+    return scanned[entry.path] if entry.path in scanned else get_tags(entry.path)
+
+
+def get_scan_paths(entries, extinf=False):
+    return [x.path for x in entries if not (extinf and x.title is not None)]
+
+
+def read_playlist_frame(playlist, replacepath, regex_flag=False, extinf=False, scan_workers=DEFAULT_SCAN_WORKERS,
+                        scan_processes=False, entries=None, scanned=None, missing=0):
+
+    columns = {x: [] for x in ('id',) + db_store.TAG_COLUMNS}
+    missing_paths = []
+
+    if entries is not None:
+        chunks = [(entries, scanned or {})]
+    else:
+        replace = compile_replace(replacepath, regex_flag=regex_flag)
+        chunks = ((x, scan_tags(get_scan_paths(x, extinf=extinf), workers=scan_workers, processes=scan_processes))
+                  for x in iter_chunks(iter_playlist(playlist, replace, missing=missing_paths)))
+
+    for chunk, chunk_scanned in chunks:
+        for entry in chunk:
+            tags = get_entry_tags(entry, chunk_scanned, extinf=extinf)
+            columns['id'].append(get_track_id(tags['title'], tags['artist'], tags['album']))
+            for column in db_store.TAG_COLUMNS:
+                columns[column].append(tags.get(column))
+
+    missing = missing + len(missing_paths)
+    if missing:
+        logger.warning('Playlist ({}) [{}]: {} entries point to files that do not exist'.format(
+            'Local', Path(playlist).stem, missing))
+
+    # An unmounted library looks like an empty playlist; syncing that would wipe the Spotify playlist
+    if missing and not columns['id']:
+        raise FileNotFoundError('None of the {} entries in \'{}\' exist'.format(missing, playlist))
+
+    df = pd.DataFrame(columns).set_index('id')
+    for column in CATEGORICAL_COLUMNS:
+        df[column] = df[column].astype('category')
+    df['spotifyid'] = 'NIL'
+    df['whitelist'] = True
+
+    return df
+
+
+def join_stored_tracks(df, name):
+
+    rows = db_store.get_playlist_tracks(name)
+
+    if not rows:
+        return
+
+    stored = pd.DataFrame(rows, columns=['id', 'spotifyid', 'whitelist']).drop_duplicates('id')
+    positions = pd.Index(stored['id']).get_indexer(df.index)
+    found = positions >= 0
+
+    df['spotifyid'] = np.where(found, stored['spotifyid'].to_numpy()[positions], 'NIL')
+    df['whitelist'] = np.where(found, stored['whitelist'].to_numpy(dtype=bool)[positions], True)
+
+
+# noinspection PyTypeChecker
+@metrics.timed('phase_seconds', phase='local')
+def playlist_csv_manager(playlist, replacepath, force_update=False, regex_flag=False,
+                         miss_ttl=resolution_cache.MISS_TTL, workers=DEFAULT_WORKERS, extinf=False,
+                         scan_workers=DEFAULT_SCAN_WORKERS, scan_processes=False, entries=None, scanned=None,
+                         missing=0, market=None):
+
+    playlist_obj = get_playlist(playlist)
+    df = read_playlist_frame(playlist, replacepath, regex_flag=regex_flag, extinf=extinf, scan_workers=scan_workers,
+                             scan_processes=scan_processes, entries=entries, scanned=scanned, missing=missing)
+    save_index()
+    join_stored_tracks(df, playlist_obj.get_name())
 
     logger.debug('Playlist ({}) [{}]: Started populating Spotify track IDs'.format('Local', Path(playlist).stem))
-    df['spotifyid'] = df.apply(lambda row: get_spotify_id_nullsafe(
-        row['title'], row['artist'], row['album'], row['spotifyid'], force_update=force_update), axis=1)
+    df['spotifyid'] = populate_spotify_ids(df, force_update=force_update, miss_ttl=miss_ttl, workers=workers,
+                                           market=market)
 
-    logger.debug('Playlist ({}) [{}]: Writing CSV to \'{}\''.format('Local', playlist_obj.get_name(), playlist_db))
-    df.to_csv(playlist_db, encoding='utf-8-sig')
+    logger.debug('Playlist ({}) [{}]: Writing tracks to the database'.format('Local', playlist_obj.get_name()))
+    db_store.replace_playlist_tracks(playlist_obj.get_name(), df)
 
     return df
 
 
 def playlists_db(playlists):
 
-    playlist_objs = [Playlist(x) for x in playlists]
-    playlist_df = pd.DataFrame(playlist_objs).sort_values(by='name').reset_index(drop=True)
-
-    Path('db').mkdir(parents=True, exist_ok=True)
     Path('artwork').mkdir(parents=True, exist_ok=True)
-    playlist_db = 'db/{}.csv'.format('playlist')
 
-    if not os.path.isfile(playlist_db):
-        logger.debug('SpotiM3U ({}): Writing CSV to \'{}\''.format('DB', playlist_db))
-        playlist_df.to_csv(playlist_db, encoding='utf-8-sig', index=False)
-    else:
-        logger.debug('SpotiM3U ({}): Updating CSV \'{}\''.format('DB', playlist_db))
-        csv_df = pd.read_csv(playlist_db).sort_values(by='name').reset_index(drop=True)
-        playlist_df = pd.concat([playlist_df, csv_df]).\
-            drop_duplicates(subset='name', keep='last').sort_values(by='name').reset_index(drop=True)
-        playlist_df.to_csv(playlist_db, encoding='utf-8-sig', index=False)
+    logger.debug('SpotiM3U ({}): Updating playlists'.format('DB'))
+    db_store.insert_playlists(Playlist(x) for x in playlists)
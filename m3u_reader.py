@@ -0,0 +1,94 @@
+import logging
+import os
+import re
+from collections import namedtuple
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+EXTINF_RE = re.compile(r'#EXTINF\s*:\s*(-?\d+(?:\.\d+)?)[^,]*,(.*)$')
+
+M3UEntry = namedtuple('M3UEntry', ['path', 'duration', 'artist', 'title'])
+
+
+def compile_replace(replacepath, regex_flag=False):
+
+    source, target = replacepath
+
+    if not source:
+        return None
+
+    if regex_flag:
+        pattern = re.compile(source)
+        return lambda path: pattern.sub(target, path)
+
+    return lambda path: path.replace(source, target)
+
+
+def parse_extinf(line):
+
+    match = EXTINF_RE.match(line)
+
+    if match is None:
+        return None, None, None
+
+    duration = float(match.group(1))
+    display = match.group(2).strip()
+    artist, sep, title = display.partition(' - ')
+
+    if not sep:
+        return duration, None, display or None
+
+    return duration, artist.strip() or None, title.strip() or None
+
+
+def iter_playlist(playlist, replace=None, missing=None):
+
+    extinf = (None, None, None)
+
+    logger.debug('Playlist ({}): Streaming file \'{}\''.format('Local', playlist))
+    with open(playlist, 'r', encoding='utf-8-sig') as fp:
+        for line in fp:
+            line = line.strip()
+
+            if not line:
+                continue
+
+            if line.startswith('#'):
+                if line.upper().startswith('#EXTINF'):
+                    extinf = parse_extinf(line)
+                continue
+
+            path = replace(line) if replace is not None else line
+            if os.path.isfile(path):
+                yield M3UEntry(path, *extinf)
+            elif missing is not None:
+                missing.append(path)
+
+            extinf = (None, None, None)
+
+
+def stat_playlists(playlists):
+
+    stats = {}
+
+    for playlist in playlists:
+        try:
+            stat = os.stat(playlist)
+        except OSError:
+            continue
+        stats[playlist] = (stat.st_mtime_ns, stat.st_size)
+
+    return stats
+
+
+def iter_chunks(iterable, size=CHUNK_SIZE):
+
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -2,39 +2,92 @@ import argparse
 import glob
 import logging
 import sys
+from pathlib import Path
 
-from local_playlist_manager import playlists_db, playlist_csv_manager, local_trackids_dupeexists
-from spotify_playlist_manager import process_playlist
+import db_store
+import mbz_dump
+import metrics
+from playlist_scheduler import DEFAULT_LOCAL_WORKERS, DEFAULT_SYNC_WORKERS, schedule_playlists
+from playlist_watcher import DEFAULT_DEBOUNCE, PlaylistWatcher
+from resolution_cache import MISS_TTL
+from spotify_query_manager import DEFAULT_MARKET, DEFAULT_WORKERS
+from sync_state import get_playlist_files, is_library_unchanged
+from tag_index import DEFAULT_SCAN_WORKERS, save_index
+from track_verifier import verify_library
 
 
-def playlist_iter(plpath, replacement_tuple=('', ''), cacheflag=False, force_update=False, update_art=False,
-                  regex_flag=False):
-
-    logger = logging.getLogger(__name__)
+def get_playlist_pattern(plpath):
 
     ext = '/**/*.m3u?*'
 
     if '.m3u' not in plpath:
         plpath = plpath + ext
 
-    playlists = glob.glob(plpath, recursive=True)
+    return plpath
+
+
+def playlist_iter(plpath, replacement_tuple=('', ''), cacheflag=False, force_update=False, update_art=False,
+                  regex_flag=False, miss_ttl=MISS_TTL, dry_run=False, workers=DEFAULT_WORKERS,
+                  scan_workers=DEFAULT_SCAN_WORKERS, scan_processes=False, local_workers=DEFAULT_LOCAL_WORKERS,
+                  sync_workers=DEFAULT_SYNC_WORKERS, extinf=False, verify=False, market=DEFAULT_MARKET,
+                  playlists=None, skip_unchanged=False):
+
+    logger = logging.getLogger(__name__)
+
+    if playlists is None:
+        playlists = glob.glob(get_playlist_pattern(plpath), recursive=True)
+
+    files = get_playlist_files(playlists, repr((tuple(replacement_tuple), regex_flag, extinf)))
+
+    if skip_unchanged and is_library_unchanged(files):
+        logger.info('SpotiM3U ({}): No playlist changed since the last run, nothing to do'.format('Run'))
+        return {}
+
+    # Pandas and the rest of the local stage are only loaded once there is work to do
+    from library_plan import plan_library
+    from local_playlist_manager import playlist_csv_manager, playlists_db, report_duplicates
+    from spotify_playlist_manager import process_playlist
 
     playlists_db(playlists)
 
-    for playlist in playlists:
+    if verify:
+        logger.debug('SpotiM3U ({}): Verification of stored track IDs is enabled'.format('Pref'))
+        verify_library(workers=workers, market=market)
 
-        if cacheflag:
-            logger.debug('SpotiM3U ({}): Cache-only mode is enabled'.format('Pref'))
+    if cacheflag:
+        logger.debug('SpotiM3U ({}): Cache-only mode is enabled'.format('Pref'))
 
-        playlist_df = playlist_csv_manager(playlist, replacement_tuple,
-                                           force_update=force_update, regex_flag=regex_flag)
-        dupeflag = local_trackids_dupeexists(playlist_df)
+    # Every playlist is read and every distinct file scanned once up front; the stages below only assemble frames
+    entries, scanned, missing = plan_library(playlists, replacement_tuple, regex_flag=regex_flag, extinf=extinf,
+                                             scan_workers=scan_workers, scan_processes=scan_processes)
 
-        if dupeflag:
-            logger.warning('Playlist ({}): Dupe track IDs detected in {}, processing skipped'.format('Local', playlist))
+    def prepare_playlist(playlist):
 
-        if not cacheflag and not dupeflag:
-            process_playlist(playlist_df, playlist, update_art=update_art)
+        # Tracks a verify run resets are searched in the market they were found unplayable in
+        playlist_df = playlist_csv_manager(playlist, replacement_tuple, force_update=force_update,
+                                           regex_flag=regex_flag, miss_ttl=miss_ttl, workers=workers, extinf=extinf,
+                                           scan_workers=scan_workers, scan_processes=scan_processes,
+                                           entries=entries.pop(playlist, None), scanned=scanned,
+                                           missing=missing.pop(playlist, 0), market=market if verify else None)
+
+        report_duplicates(playlist_df, Path(playlist).stem)
+
+        return None if cacheflag else playlist_df
+
+    def sync_playlist(playlist, playlist_df):
+        process_playlist(playlist_df, playlist, update_art=update_art, dry_run=dry_run)
+
+    failed = schedule_playlists(playlists, prepare_playlist, sync_playlist, local_workers=local_workers,
+                                sync_workers=sync_workers)
+
+    save_index()
+
+    # A failed playlist may be half-synced, so its last good record must not let the next run skip it
+    db_store.delete_playlist_files(failed)
+    if not (cacheflag or dry_run):
+        db_store.upsert_playlist_files({x: y for x, y in files.items() if x not in failed})
+
+    return failed
 
 
 def logging_initiate(loglevel='info'):
@@ -67,22 +120,113 @@ def logging_initiate(loglevel='info'):
 def main():
 
     parser = argparse.ArgumentParser(description='Sync Spotify playlists to local M3U/M3U8 playlists.')
-    parser.add_argument('playlist_folder', type=str, help='Directory containing all the M3U/M38 files.')
+    parser.add_argument('playlist_folder', type=str, nargs='?', help='Directory containing all the M3U/M38 files.')
     parser.add_argument('--cacheonly', action='store_true', help='Cache the results without updating Spotify.')
     parser.add_argument('--forceupdate', action='store_true', help='Force query tracks that are not available.')
+    parser.add_argument('--missttl', type=float, default=MISS_TTL / 86400,
+                        help='Days before a cached unavailable track is queried again on force update.')
+    parser.add_argument('--dryrun', action='store_true', help='Report planned playlist changes without applying them.')
     parser.add_argument('--updateart', action='store_true', help='Update artwork in the playlists.')
     parser.add_argument('--replacefrom', type=str, help='Text to be replaced in the playlists.')
     parser.add_argument('--replaceto', type=str, help='Replacement text for the playlists.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of concurrent Spotify searches.')
+    parser.add_argument('--scanworkers', type=int, default=DEFAULT_SCAN_WORKERS,
+                        help='Number of concurrent tag readers for the library scan.')
+    parser.add_argument('--scanprocesses', action='store_true',
+                        help='Read tags in worker processes instead of threads.')
+    parser.add_argument('--localworkers', type=int, default=DEFAULT_LOCAL_WORKERS,
+                        help='Number of playlists read and resolved concurrently.')
+    parser.add_argument('--syncworkers', type=int, default=DEFAULT_SYNC_WORKERS,
+                        help='Number of playlists synced with Spotify concurrently.')
+    parser.add_argument('--extinf', action='store_true',
+                        help='Take artist and title from #EXTINF lines instead of reading the audio file tags.')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check stored track IDs against Spotify and re-resolve missing or unplayable ones.')
+    parser.add_argument('--market', type=str, default=DEFAULT_MARKET,
+                        help='Market to check playability in for --verify (default: the user\'s own).')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Sync every playlist even if no M3U file changed since the last run.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and sync playlists again whenever their M3U files change.')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help='Seconds the playlists must stay unchanged before a watch sync starts.')
     parser.add_argument('--loglevel', type=str, default='info', help='Set the logging level.')
     parser.add_argument('--regex', action='store_true', help='Use regex matching for replace.')
+    parser.add_argument('--metrics', type=str,
+                        help='Write run metrics to this file (.json, otherwise Prometheus textfile format).')
+    parser.add_argument('--importcsv', action='store_true', help='Import the CSVs in db/ into the database and exit.')
+    parser.add_argument('--exportcsv', action='store_true', help='Export the database as CSVs in db/ and exit.')
+    parser.add_argument('--importmbz', type=str,
+                        help='Import artist sort names from a MusicBrainz artist dump (JSON or TSV) and exit.')
     args = parser.parse_args()
 
+    if args.playlist_folder is None and not (args.importcsv or args.exportcsv or args.importmbz):
+        parser.error('the following arguments are required: playlist_folder')
+
     args.replacefrom = args.replacefrom if args.replacefrom is not None else ''
     args.replaceto = args.replaceto if (args.replaceto is not None and args.replacefrom != '') else ''
 
     logging_initiate(args.loglevel)
-    playlist_iter(args.playlist_folder, replacement_tuple=(args.replacefrom, args.replaceto), cacheflag=args.cacheonly,
-                  force_update=args.forceupdate, update_art=args.updateart, regex_flag=args.regex)
+
+    if args.importcsv or args.exportcsv or args.importmbz:
+        if args.importcsv:
+            db_store.import_csv()
+        if args.importmbz:
+            mbz_dump.import_dump(args.importmbz)
+        if args.exportcsv:
+            db_store.export_csv()
+        db_store.close_connection()
+        return
+
+    logger = logging.getLogger(__name__)
+
+    def run(playlists=None, verify=False, skip_unchanged=False):
+
+        failed = playlist_iter(args.playlist_folder, replacement_tuple=(args.replacefrom, args.replaceto),
+                               cacheflag=args.cacheonly, force_update=args.forceupdate, update_art=args.updateart,
+                               regex_flag=args.regex, miss_ttl=args.missttl * 86400, dry_run=args.dryrun,
+                               workers=args.workers, scan_workers=args.scanworkers,
+                               scan_processes=args.scanprocesses, local_workers=args.localworkers,
+                               sync_workers=args.syncworkers, extinf=args.extinf, verify=verify, market=args.market,
+                               playlists=playlists, skip_unchanged=skip_unchanged)
+
+        metrics.log_summary()
+        if args.metrics:
+            metrics.write(args.metrics)
+
+        if failed:
+            logger.error('SpotiM3U ({}): {} playlists failed: {}'.format(
+                'Run', len(failed), ', '.join(sorted(Path(x).stem for x in failed))))
+
+        return failed
+
+    # Snapshot before the first sync so edits made while it runs are picked up straight after
+    watcher = PlaylistWatcher(get_playlist_pattern(args.playlist_folder), debounce=args.debounce) \
+        if args.watch else None
+
+    failed = run(verify=args.verify, skip_unchanged=not (args.rescan or args.verify or args.forceupdate or
+                                                         args.updateart or args.dryrun))
+
+    if watcher is not None:
+        # Tag index, resolution cache and Spotify clients live at module level, so every cycle starts warm
+        try:
+            while True:
+                playlists = watcher.wait()
+                metrics.reset()
+                try:
+                    run(playlists=playlists)
+                except Exception as e:
+                    logger.error('SpotiM3U ({}): Watch sync failed, still watching: {}'.format('Run', e),
+                                 exc_info=True)
+        except KeyboardInterrupt:
+            logger.info('SpotiM3U ({}): Watch stopped'.format('Run'))
+        finally:
+            watcher.close()
+
+    db_store.close_connection()
+
+    if failed and watcher is None:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+import math
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+MATCH_THRESHOLD = 0.75
+WEIGHTS = {'title': 0.45, 'artist': 0.3, 'album': 0.1, 'length': 0.15}
+LENGTH_TOLERANCE = 3
+LENGTH_CUTOFF = 20
+
+DECORATION_RE = re.compile(r'\s*[(\[][^)\]]*\b(feat|ft|with|remaster(ed)?|version|edit|mono|stereo|deluxe|'
+                           r'edition)\b[^)\]]*[)\]]|\s+-\s+.*\b(remaster(ed)?|version|edit|mix|live)\b.*$', re.I)
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+
+def is_missing(value):
+    return value is None or value == '' or (isinstance(value, float) and math.isnan(value))
+
+
+def normalise(value, strip_decoration=False):
+
+    value = unicodedata.normalize('NFKC', str(value)).casefold()
+
+    if strip_decoration:
+        value = DECORATION_RE.sub('', value)
+
+    return ' '.join(PUNCTUATION_RE.sub(' ', value).split())
+
+
+def similarity(left, right, strip_decoration=False):
+
+    left = normalise(left, strip_decoration=strip_decoration)
+    right = normalise(right, strip_decoration=strip_decoration)
+
+    if not left or not right:
+        return 0.0
+    if left == right:
+        return 1.0
+
+    return SequenceMatcher(None, left, right).ratio()
+
+
+def get_length_score(length, duration_ms):
+
+    difference = abs(length - duration_ms / 1000)
+
+    if difference <= LENGTH_TOLERANCE:
+        return 1.0
+
+    return max(0.0, 1 - (difference - LENGTH_TOLERANCE) / (LENGTH_CUTOFF - LENGTH_TOLERANCE))
+
+
+def score_candidate(candidate, title, artists, album=None, length=None):
+
+    scores = {'title': similarity(title, candidate.get('name') or '', strip_decoration=True)}
+
+    candidate_artists = [x.get('name') or '' for x in candidate.get('artists') or []]
+    if artists:
+        scores['artist'] = max((similarity(x, y) for x in artists for y in candidate_artists), default=0.0)
+
+    candidate_album = (candidate.get('album') or {}).get('name')
+    if not is_missing(album) and candidate_album:
+        scores['album'] = similarity(album, candidate_album, strip_decoration=True)
+
+    if not is_missing(length) and candidate.get('duration_ms'):
+        scores['length'] = get_length_score(length, candidate['duration_ms'])
+
+    # Fields we know nothing about locally drop out instead of counting as mismatches
+    return sum(WEIGHTS[x] * y for x, y in scores.items()) / sum(WEIGHTS[x] for x in scores)
+
+
+def pick_candidate(candidates, title, artists, album=None, length=None, threshold=MATCH_THRESHOLD):
+
+    artists = [x for x in artists if not is_missing(x)]
+    best = max(((score_candidate(x, title, artists, album=album, length=length), -idx, x['id'])
+                for idx, x in enumerate(candidates) if x is not None and x.get('id')), default=None)
+
+    return best[2] if best is not None and best[0] >= threshold else None
@@ -0,0 +1,82 @@
+import bz2
+import gzip
+import io
+import json
+import logging
+import lzma
+import re
+import tarfile
+import time
+
+import db_store
+from mbz_utils import get_artist_key
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+ARTIST_MEMBER = 'mbdump/artist'
+ESCAPE_RE = re.compile(r'\\(.)')
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def iter_dump_lines(path):
+
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path) as tar:
+            member = next((x for x in tar if x.name == ARTIST_MEMBER or x.name.endswith('/' + ARTIST_MEMBER)), None)
+            if member is None:
+                raise ValueError('No {} in \'{}\''.format(ARTIST_MEMBER, path))
+            yield from io.TextIOWrapper(tar.extractfile(member), encoding='utf-8')
+        return
+
+    opener = next((y for x, y in OPENERS.items() if path.endswith(x)), open)
+    with opener(path, 'rt', encoding='utf-8') as fp:
+        yield from fp
+
+
+def unescape(value):
+    return None if value == '\\N' else ESCAPE_RE.sub(lambda x: {'t': '\t', 'n': '\n', 'r': '\r'}.get(x.group(1),
+                                                                                                  x.group(1)), value)
+
+
+def parse_dump_line(line):
+
+    line = line.rstrip('\n')
+
+    if not line:
+        return []
+
+    # JSON dumps carry aliases, so native-script aliases also map to the artist's sort name
+    if line.startswith('{'):
+        artist = json.loads(line)
+        return [(artist.get('name'), artist.get('sort-name'))] + \
+            [(x.get('name'), artist.get('sort-name')) for x in artist.get('aliases') or []]
+
+    # The artist table of the PostgreSQL dump starts with id, gid, name, sort_name; plain name/sort name pairs work too
+    fields = [unescape(x) for x in line.split('\t')]
+    return [(fields[2], fields[3])] if len(fields) >= 4 else [tuple(fields[:2])] if len(fields) == 2 else []
+
+
+def import_dump(path):
+
+    rows = []
+    imported = 0
+    updated = int(time.time())
+
+    logger.info('SpotiM3U ({}): Importing MusicBrainz artists from \'{}\''.format('DB', path))
+    for line in iter_dump_lines(path):
+        for name, sort_name in parse_dump_line(line):
+            if name and sort_name:
+                rows.append((get_artist_key(name), sort_name.replace(',', ''), 'dump', updated))
+
+        if len(rows) >= BATCH_SIZE:
+            db_store.upsert_artist_names(rows, keep_known=True)
+            imported = imported + len(rows)
+            rows = []
+            logger.debug('SpotiM3U ({}): Imported {} artist names'.format('DB', imported))
+
+    db_store.upsert_artist_names(rows, keep_known=True)
+    imported = imported + len(rows)
+    logger.info('SpotiM3U ({}): Imported {} artist names'.format('DB', imported))
+
+    return imported
@@ -1,17 +1,35 @@
 import logging
-import os
-import yaml
+import time
+from threading import Lock
 
-import musicbrainzngs
+import db_store
+import metrics
+from client_registry import load_config
+from match_scoring import is_missing
+from rate_limiter import mbz_limiter
 
 logger = logging.getLogger(__name__)
 
+ARTIST_MISS_TTL = 30 * 24 * 60 * 60
+
+_auth_lock = Lock()
+_auth_set = False
+_romanised_lock = Lock()
+_romanised = {}
+
 
 def set_auth(config_file='config.yaml'):
 
-    if os.path.isfile(config_file):
-        with open(config_file, 'r') as fp:
-            auth_dict = yaml.safe_load(fp)
+    global _auth_set
+
+    with _auth_lock:
+        if _auth_set:
+            return
+
+        import musicbrainzngs
+        auth_dict = load_config(config_file)
+
+        if auth_dict is not None:
             try:
                 creds = auth_dict['mbz_creds']
                 logger.debug('Auth ({}): Setting user-agent and rate-limit'.format('MBZ'))
@@ -20,17 +38,58 @@ def set_auth(config_file='config.yaml'):
                                              contact=creds['useragent']['contact'])
                 musicbrainzngs.set_rate_limit(limit_or_interval=float(creds['rate_limit']['limit_or_interval']),
                                               new_requests=int(creds['rate_limit']['new_requests']))
+                _auth_set = True
             except (TypeError, KeyError):
                 logger.error('SpotiM3U ({}): Invalid YAML (MBZ)'.format('Func'))
 
 
+def get_artist_key(artist):
+    return ' '.join(str(artist).casefold().split())
+
+
+def get_stored_name(key, miss_ttl=ARTIST_MISS_TTL):
+
+    entry = db_store.get_artist_name(key)
+
+    if entry is None or (entry['sort_name'] is None and time.time() - entry['updated'] >= miss_ttl):
+        return False, None
+
+    return True, entry['sort_name']
+
+
 def get_romanised_name(artist):
 
+    if is_missing(artist):
+        return None
+
+    key = get_artist_key(artist)
+
+    # Held across the lookup so concurrent tracks by one artist wait for a single MBZ query
+    with _romanised_lock:
+        found = key in _romanised
+        if not found:
+            found, romanised_name = get_stored_name(key)
+            if not found:
+                romanised_name = query_romanised_name(artist)
+                db_store.upsert_artist_names([(key, romanised_name, 'mbz', int(time.time()))])
+            _romanised[key] = romanised_name
+
+        metrics.inc('romanised_cache', result='hit' if found else 'miss')
+        return _romanised[key]
+
+
+@metrics.timed('mbz_lookup_seconds')
+def query_romanised_name(artist):
+
+    import musicbrainzngs
     set_auth()
 
     romanised_name = None
     logger.debug('Query ({}): Querying with \'{}\''.format('MBZ', artist))
+    mbz_limiter.acquire()
     artist_search_result = musicbrainzngs.search_artists(artist=artist, limit=5)
+    metrics.inc('mbz_requests')
+    metrics.attribute('playlist_http_requests')
 
     if artist_search_result['artist-count'] > 0:
         romanised_name = artist_search_result['artist-list'][0]['sort-name'].replace(',', '')
@@ -0,0 +1,224 @@
+import functools
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock, local
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'spotim3u'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = Lock()
+_counters = defaultdict(float)
+_histograms = {}
+_scope = local()
+
+
+class Histogram:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value):
+
+        self.count = self.count + 1
+        self.total = self.total + value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        for idx, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[idx] = self.buckets[idx] + 1
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.total, 6), 'min': self.minimum, 'max': self.maximum,
+                'buckets': dict(zip(BUCKETS, self.buckets))}
+
+
+def get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        _counters[get_key(name, labels)] += value
+
+
+def observe(name, value, **labels):
+
+    key = get_key(name, labels)
+
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(value)
+
+
+@contextmanager
+def timer(name, **labels):
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def scope(**labels):
+
+    outer = get_scope()
+    _scope.labels = labels
+    try:
+        yield
+    finally:
+        _scope.labels = outer
+
+
+def get_scope():
+    return getattr(_scope, 'labels', None)
+
+
+def bind(func):
+
+    labels = get_scope()
+
+    if labels is None:
+        return func
+
+    # Worker threads do not inherit the submitting thread's scope, so carry it over explicitly
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with scope(**labels):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def attribute(name, value=1):
+
+    labels = get_scope()
+
+    if labels is not None:
+        inc(name, value, **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def format_name(name, labels):
+    return name + ('{' + ','.join('{}={}'.format(*x) for x in labels) + '}' if labels else '')
+
+
+def get_hit_rates():
+
+    with _lock:
+        counts = defaultdict(lambda: defaultdict(float))
+        for (name, labels), value in _counters.items():
+            label_dict = dict(labels)
+            if name.endswith('_cache') and label_dict.get('result') in ('hit', 'miss'):
+                counts[name][label_dict['result']] += value
+
+    return {name: x['hit'] / (x['hit'] + x['miss']) for name, x in counts.items() if x['hit'] + x['miss']}
+
+
+def to_dict():
+
+    with _lock:
+        counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(_counters.items())]
+        histograms = [dict(name=name, labels=dict(labels), **histogram.to_dict())
+                      for (name, labels), histogram in sorted(_histograms.items())]
+
+    return {'counters': counters, 'histograms': histograms, 'hit_rates': get_hit_rates()}
+
+
+def format_prom_labels(labels, extra=()):
+
+    pairs = list(labels) + list(extra)
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in pairs) + '}' if pairs else ''
+
+
+def to_prometheus():
+
+    lines = []
+
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append('{}_{}_total{} {}'.format(PREFIX, name, format_prom_labels(labels), value))
+
+        for (name, labels), histogram in sorted(_histograms.items()):
+            metric = '{}_{}'.format(PREFIX, name)
+            for bound, count in zip(BUCKETS, histogram.buckets):
+                lines.append('{}_bucket{} {}'.format(metric, format_prom_labels(labels, [('le', bound)]), count))
+            lines.append('{}_bucket{} {}'.format(metric, format_prom_labels(labels, [('le', '+Inf')]),
+                                                 histogram.count))
+            lines.append('{}_sum{} {}'.format(metric, format_prom_labels(labels), histogram.total))
+            lines.append('{}_count{} {}'.format(metric, format_prom_labels(labels), histogram.count))
+
+    for name, rate in sorted(get_hit_rates().items()):
+        lines.append('{}_{}_hit_ratio {}'.format(PREFIX, name, rate))
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_summary_lines():
+
+    lines = ['{:<60} {:>8} {:>10} {:>10} {:>10}'.format('timer', 'count', 'total s', 'mean s', 'max s')]
+
+    with _lock:
+        histograms = sorted(_histograms.items(), key=lambda x: x[1].total, reverse=True)
+        counters = sorted(_counters.items())
+
+    for (name, labels), histogram in histograms:
+        lines.append('{:<60} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            format_name(name, labels), histogram.count, histogram.total, histogram.total / histogram.count,
+            histogram.maximum))
+
+    lines.append('{:<60} {:>8}'.format('counter', 'value'))
+    for (name, labels), value in counters:
+        lines.append('{:<60} {:>8g}'.format(format_name(name, labels), value))
+
+    for name, rate in sorted(get_hit_rates().items()):
+        lines.append('{:<60} {:>7.1f}%'.format(name + ' hit rate', rate * 100))
+
+    return lines
+
+
+def log_summary():
+    for line in get_summary_lines():
+        logger.info('Metrics ({}): {}'.format('Run', line))
+
+
+def write(path):
+
+    logger.debug('Metrics ({}): Writing \'{}\''.format('Run', path))
+    with open(path, 'w', encoding='utf-8') as fp:
+        if path.endswith('.json'):
+            json.dump(to_dict(), fp, indent=2)
+        else:
+            fp.write(to_prometheus())
@@ -0,0 +1,48 @@
+from collections import Counter
+
+from reorder_planner import plan_reorder
+
+
+class PlaylistDiff:
+
+    def __init__(self, local_trackids, sp_trackids):
+
+        local_counts = Counter(local_trackids)
+        kept_counts = Counter()
+
+        self.removals = []
+        self.expected = []
+
+        # Remote occurrences beyond what the local playlist holds are removed by position
+        for position, trackid in enumerate(sp_trackids):
+            if kept_counts[trackid] < local_counts[trackid]:
+                kept_counts[trackid] = kept_counts[trackid] + 1
+                self.expected.append(trackid)
+            else:
+                self.removals.append((trackid, position))
+
+        self.additions = []
+        for trackid in local_trackids:
+            if kept_counts[trackid] > 0:
+                kept_counts[trackid] = kept_counts[trackid] - 1
+            else:
+                self.additions.append(trackid)
+
+        self.expected.extend(self.additions)
+        self.moves = plan_reorder(self.expected, local_trackids)
+
+    def get_removal_batches(self, length=100):
+
+        removals = sorted(self.removals, key=lambda x: x[1], reverse=True)
+
+        # Highest positions first, so each batch leaves the positions of the next one untouched
+        return [[{'uri': trackid, 'positions': [position]} for trackid, position in removals[x:x + length]]
+                for x in range(0, len(removals), length)]
+
+    def get_addition_batches(self, length=100):
+        return [self.additions[x:x + length] for x in range(0, len(self.additions), length)]
+
+    def get_steps(self):
+        return [['prune', x] for x in self.get_removal_batches()] + \
+            [['add', x] for x in self.get_addition_batches()] + \
+            [['reorder', list(x)] for x in self.moves]
@@ -0,0 +1,57 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_WORKERS = 2
+DEFAULT_SYNC_WORKERS = 2
+
+
+def run_stage(stage, playlist, func, *args):
+
+    name = Path(playlist).stem
+
+    with metrics.scope(playlist=name), metrics.timer('playlist_seconds', playlist=name, stage=stage):
+        return func(*args)
+
+
+def schedule_playlists(playlists, local_func, sync_func, local_workers=DEFAULT_LOCAL_WORKERS,
+                       sync_workers=DEFAULT_SYNC_WORKERS):
+
+    queued = list(reversed(playlists))
+    pending = {}
+    failed = {}
+
+    logger.debug('SpotiM3U ({}): Scheduling {} playlists with {} local and {} sync workers'.format(
+        'Func', len(playlists), local_workers, sync_workers))
+
+    with ThreadPoolExecutor(max_workers=local_workers) as local_pool, \
+            ThreadPoolExecutor(max_workers=sync_workers) as sync_pool:
+
+        while queued or pending:
+            # Only read ahead as far as the sync lane can absorb, so finished playlists do not pile up in memory
+            while queued and len(pending) < local_workers + sync_workers:
+                playlist = queued.pop()
+                pending[local_pool.submit(run_stage, 'local', playlist, local_func, playlist)] = ('local', playlist)
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, playlist = pending.pop(future)
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error('Playlist ({}) [{}]: Failed during {}, playlist skipped: {}'.format(
+                        'Local' if stage == 'local' else 'Spotify', Path(playlist).stem, stage, e), exc_info=True)
+                    metrics.inc('playlists_failed', stage=stage)
+                    failed[playlist] = e
+                    continue
+
+                if stage == 'local' and result is not None:
+                    pending[sync_pool.submit(run_stage, 'sync', playlist, sync_func, playlist, result)] = \
+                        ('sync', playlist)
+
+    return failed
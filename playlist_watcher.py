@@ -0,0 +1,160 @@
+import ctypes
+import ctypes.util
+import glob
+import logging
+import os
+import select
+import struct
+import time
+
+from m3u_reader import stat_playlists
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5
+RESCAN_INTERVAL = 300
+DEFAULT_DEBOUNCE = 2
+# IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+INOTIFY_MASK = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+# IN_MOVED_TO, IN_CREATE
+NEW_ENTRY_MASK = 0x80 | 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 65536
+
+
+def get_watch_root(pattern):
+
+    magic = min((pattern.find(x) for x in '*?[' if x in pattern), default=len(pattern))
+
+    return os.path.dirname(pattern[:magic]) or '.'
+
+
+def open_inotify():
+
+    # No C library to load on Windows, and no inotify outside Linux; both fall back to polling
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None, None
+
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None, None
+
+    return (libc, fd) if fd >= 0 else (None, None)
+
+
+class PlaylistWatcher:
+
+    def __init__(self, pattern, debounce=DEFAULT_DEBOUNCE, interval=POLL_INTERVAL, rescan=RESCAN_INTERVAL):
+        self.pattern = pattern
+        self.root = get_watch_root(pattern)
+        self.recursive = '**' in pattern
+        self.debounce = debounce
+        self.interval = interval
+        self.rescan = rescan
+        self.libc, self.fd = open_inotify()
+        self.watched = {}
+        if self.recursive:
+            self.add_tree(self.root)
+        self.mtimes = self.get_mtimes()
+
+        logger.info('Watch ({}): Watching \'{}\' with {}'.format(
+            'Local', self.pattern, 'inotify' if self.fd is not None else
+            'polling every {}s'.format(self.interval)))
+
+    def get_mtimes(self):
+
+        mtimes = stat_playlists(glob.glob(self.pattern, recursive=True))
+        self.add_watches({os.path.dirname(x) or '.' for x in mtimes} | {self.root})
+
+        return mtimes
+
+    def add_tree(self, directory):
+        self.add_watches(x for x, _, _ in os.walk(directory))
+
+    def add_watches(self, directories):
+
+        if self.fd is None:
+            return
+
+        for directory in set(directories) - set(self.watched.values()):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+            if wd < 0:
+                # Usually the watch limit; the periodic rescan still picks these up
+                logger.debug('Watch ({}): Could not watch \'{}\': {}'.format(
+                    'Local', directory, os.strerror(ctypes.get_errno())))
+                continue
+            self.watched[wd] = directory
+
+    def read_events(self):
+
+        data = b''
+        try:
+            while True:
+                chunk = os.read(self.fd, READ_SIZE)
+                if not chunk:
+                    break
+                data = data + chunk
+        except BlockingIOError:
+            pass
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset = offset + EVENT_HEADER.size + length
+            yield wd, mask, os.fsdecode(name)
+
+    def sleep(self, timeout):
+
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+
+        select.select([self.fd], [], [], timeout)
+
+        for wd, mask, name in self.read_events():
+            if mask & IN_IGNORED:
+                self.watched.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW and self.recursive:
+                self.add_tree(self.root)
+            elif mask & IN_ISDIR and mask & NEW_ENTRY_MASK and self.recursive and wd in self.watched:
+                # Only the new directory is walked, never the whole tree again
+                self.add_tree(os.path.join(self.watched[wd], name))
+
+    def wait(self):
+
+        while True:
+            # Inotify wakes us as soon as something changes, so its rescan interval is only a safety net for missed
+            # events; what changed is always decided by comparing mtimes
+            self.sleep(self.interval if self.fd is None else self.rescan)
+            mtimes = self.get_mtimes()
+            if mtimes == self.mtimes:
+                continue
+
+            # Editors and sync clients write in bursts, so wait for the folder to settle first
+            while True:
+                time.sleep(self.debounce)
+                settled = self.get_mtimes()
+                if settled == mtimes:
+                    break
+                mtimes = settled
+
+            changed = sorted(x for x, y in mtimes.items() if self.mtimes.get(x) != y)
+            self.mtimes = mtimes
+
+            if changed:
+                logger.info('Watch ({}): {} playlists changed: {}'.format(
+                    'Local', len(changed), ', '.join(os.path.basename(x) for x in changed)))
+                return changed
+
+    def close(self):
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,53 @@
+import logging
+import time
+from threading import Lock
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SPOTIFY_RATE = 10.0
+MBZ_RATE = 1.0
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None, name='Limiter'):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.name = name
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = Lock()
+
+    def acquire(self):
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+
+            metrics.inc('ratelimit_wait_seconds', wait, lane=self.name)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+        metrics.inc('backoff_seconds', seconds, lane=self.name)
+        metrics.inc('backoff_events', lane=self.name)
+        logger.warning('RateLimit ({}): Backing off for {}s'.format(self.name, seconds))
+
+
+spotify_limiter = TokenBucket(SPOTIFY_RATE, name='Spotify')
+mbz_limiter = TokenBucket(MBZ_RATE, capacity=1, name='MBZ')
@@ -0,0 +1,143 @@
+from bisect import bisect_left
+from collections import defaultdict, deque
+
+
+def get_target_positions(current, target):
+
+    slots = defaultdict(deque)
+    for idx, item in enumerate(target):
+        slots[item].append(idx)
+
+    return [slots[item].popleft() for item in current]
+
+
+def longest_increasing_subsequence(seq):
+
+    tails = []
+    tail_idx = []
+    prev = [-1] * len(seq)
+
+    for idx, value in enumerate(seq):
+        pos = bisect_left(tails, value)
+        if pos == len(tails):
+            tails.append(value)
+            tail_idx.append(idx)
+        else:
+            tails[pos] = value
+            tail_idx[pos] = idx
+        prev[idx] = tail_idx[pos - 1] if pos > 0 else -1
+
+    lis = []
+    idx = tail_idx[-1] if tail_idx else -1
+    while idx != -1:
+        lis.append(seq[idx])
+        idx = prev[idx]
+
+    return lis[::-1]
+
+
+def get_slots(order, keep):
+
+    # Every item gets its final slot up front: kept items stay where they are, every other item sits right behind
+    # the nearest kept item below it, in target order
+    kept = sorted(keep)
+    bounds = [-1] + kept + [len(order)]
+    groups = {x: range(x + 1, y) for x, y in zip(bounds, bounds[1:])}
+    current_slots = [0] * len(order)
+    final_slots = [0] * len(order)
+    slot = 0
+
+    for item in groups[-1]:
+        final_slots[item] = slot
+        slot = slot + 1
+
+    for item in order:
+        current_slots[item] = slot
+        slot = slot + 1
+        if item in keep:
+            final_slots[item] = current_slots[item]
+            for moved in groups[item]:
+                final_slots[moved] = slot
+                slot = slot + 1
+
+    return current_slots, final_slots, slot
+
+
+def update(tree, slot, delta):
+
+    slot = slot + 1
+    while slot < len(tree):
+        tree[slot] = tree[slot] + delta
+        slot = slot + (slot & -slot)
+
+
+def count_before(tree, slot):
+
+    total = 0
+    while slot > 0:
+        total = total + tree[slot]
+        slot = slot - (slot & -slot)
+
+    return total
+
+
+def find_slot(tree, position):
+
+    # Slot holding the item at this position, by descending the tree
+    slot = 0
+    step = 1 << (len(tree).bit_length() - 1)
+
+    while step:
+        if slot + step < len(tree) and tree[slot + step] <= position:
+            slot = slot + step
+            position = position - tree[slot]
+        step = step >> 1
+
+    return slot
+
+
+def plan_reorder(current, target):
+
+    # Items on the longest increasing run stay put, the rest are moved right behind their predecessor
+    order = get_target_positions(current, target)
+    keep = set(longest_increasing_subsequence(order))
+    total = len(order)
+
+    # Positions are tracked in a Fenwick tree over the slots, so each move costs O(log n) instead of a list rebuild
+    slots, final_slots, slot_count = get_slots(order, keep)
+    items = [None] * slot_count
+    tree = [0] * (slot_count + 1)
+    for item, slot in enumerate(slots):
+        items[slot] = item
+        update(tree, slot, 1)
+
+    moves = []
+    idx = 0
+
+    while idx < total:
+
+        if idx in keep:
+            idx = idx + 1
+            continue
+
+        range_start = count_before(tree, slots[idx])
+        range_length = 1
+        while idx + range_length < total and idx + range_length not in keep and range_start + range_length < total \
+                and items[find_slot(tree, range_start + range_length)] == idx + range_length:
+            range_length = range_length + 1
+
+        insert_before = count_before(tree, slots[idx - 1]) + 1 if idx > 0 else 0
+
+        if not range_start <= insert_before <= range_start + range_length:
+            moves.append((range_start, range_length, insert_before))
+
+        # A block already behind its predecessor is adjacent to its final slot too, so it can be moved there as well
+        for item in range(idx, idx + range_length):
+            update(tree, slots[item], -1)
+            slots[item] = final_slots[item]
+            items[slots[item]] = item
+            update(tree, slots[item], 1)
+
+        idx = idx + range_length
+
+    return moves
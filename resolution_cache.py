@@ -0,0 +1,98 @@
+import logging
+import math
+import time
+from hashlib import md5
+from threading import RLock
+
+import db_store
+
+logger = logging.getLogger(__name__)
+
+MISS_TTL = 7 * 24 * 60 * 60
+CHECKPOINT_EVERY = 100
+KEY_SEPARATOR = '\x1f'
+
+_lock = RLock()
+_cache = None
+_dirty = set()
+
+
+def normalise(value):
+
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+
+    return ' '.join(str(value).casefold().split())
+
+
+def get_key(title, artist, album):
+    return md5(KEY_SEPARATOR.join(normalise(x) for x in (title, artist, album)).encode()).hexdigest()
+
+
+def load_cache():
+
+    global _cache
+
+    with _lock:
+        if _cache is None:
+            logger.debug('Cache ({}): Reading resolutions'.format('Local'))
+            _cache = db_store.load_resolutions()
+
+        return _cache
+
+
+def lookup(key):
+    return load_cache().get(key)
+
+
+def store(key, title, artist, album, spotifyid):
+
+    with _lock:
+        load_cache()[key] = {'title': title, 'artist': artist, 'album': album,
+                             'spotifyid': spotifyid, 'updated': int(time.time())}
+        _dirty.add(key)
+
+
+def replace_ids(replacements):
+
+    removed = []
+
+    with _lock:
+        cache = load_cache()
+        for key, entry in list(cache.items()):
+            if entry['spotifyid'] not in replacements:
+                continue
+            if replacements[entry['spotifyid']] is None:
+                del cache[key]
+                _dirty.discard(key)
+                removed.append(key)
+            else:
+                store(key, entry['title'], entry['artist'], entry['album'], replacements[entry['spotifyid']])
+
+        if removed:
+            logger.debug('Cache ({}): Dropping {} resolutions'.format('Local', len(removed)))
+            db_store.delete_resolutions(removed)
+
+        save_cache()
+
+
+def is_stale(entry, miss_ttl=MISS_TTL):
+    return entry['spotifyid'] == 'NOT_AVAIL' and time.time() - entry['updated'] >= miss_ttl
+
+
+def save_cache():
+
+    with _lock:
+        if not _dirty:
+            return
+
+        logger.debug('Cache ({}): Writing {} resolutions'.format('Local', len(_dirty)))
+        db_store.upsert_resolutions({key: load_cache()[key] for key in _dirty})
+        _dirty.clear()
+
+
+def checkpoint(every=CHECKPOINT_EVERY):
+
+    with _lock:
+        if len(_dirty) >= every:
+            save_cache()
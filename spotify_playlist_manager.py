@@ -1,30 +1,45 @@
 import logging
+from collections import Counter
 
-import spotipy
-
+import metrics
+from artwork_cache import is_uploaded, record_upload
 from local_playlist_manager import get_playlist, get_local_trackids
-from spotify_query_manager import set_auth
+from playlist_diff import PlaylistDiff
+from spotify_query_manager import get_spotify_client, spotify_call
+from sync_state import checkpoint, get_fingerprint, is_unchanged, load_journal, record, start_journal
 
 logger = logging.getLogger(__name__)
 
+PAGE_SIZE = 100
+STEP_LOGS = {'prune': 'Pruned playlist', 'add': 'Added tracks to playlist', 'reorder': 'Reordered playlist'}
+
 
+@metrics.timed('spotify_playlist_seconds', op='fetch')
 def get_spotify_playlist(sp_obj, playlist_obj):
 
     offset = 0
     playlist_id = playlist_obj['spotifyid']
 
-    spotify_item_dicts = [sp_obj.playlist_items(playlist_id)]
+    spotify_item_dicts = [spotify_call(sp_obj.playlist_items, playlist_id, limit=PAGE_SIZE)]
     total_tracks = spotify_item_dicts[0]['total']
 
-    while total_tracks > 100:
+    while total_tracks > PAGE_SIZE:
         logger.debug('Playlist ({}) [{}]: Pagination ongoing'.format('Spotify', playlist_obj.get_spotifyname_id()))
-        offset = offset + 100
-        total_tracks = total_tracks - 100
-        spotify_item_dicts.append(sp_obj.playlist_items(playlist_id, offset=offset))
+        offset = offset + PAGE_SIZE
+        total_tracks = total_tracks - PAGE_SIZE
+        spotify_item_dicts.append(spotify_call(sp_obj.playlist_items, playlist_id, limit=PAGE_SIZE, offset=offset))
+
+    metrics.inc('spotify_playlist_pages', len(spotify_item_dicts))
 
     return spotify_item_dicts
 
 
+def get_spotify_snapshot_id(sp_obj, playlist_obj):
+
+    logger.debug('Playlist ({}) [{}]: Getting the snapshot ID'.format('Spotify', playlist_obj.get_spotifyname_id()))
+    return spotify_call(sp_obj.playlist, playlist_obj['spotifyid'], fields='snapshot_id')['snapshot_id']
+
+
 def get_spotify_playlist_trackids(sp_obj, playlist_obj):
 
     trackids = []
@@ -42,105 +57,108 @@ def get_spotify_playlist_trackids(sp_obj, playlist_obj):
     return trackids
 
 
-def prune_playlist(playlist_obj, sp_obj, local_trackids, sp_trackids):
+def apply_step(sp_obj, playlist_id, op, args, snapshot_id):
 
-    playlist_id = playlist_obj.get_spotifyid()
-    prune_trackids = [x for x in sp_trackids if x not in local_trackids]
-
-    total_prunes = len(prune_trackids)
-
-    if prune_trackids:
+    if op == 'prune':
+        result = spotify_call(sp_obj.playlist_remove_specific_occurrences_of_items, playlist_id, items=args,
+                              snapshot_id=snapshot_id)
+    elif op == 'add':
+        result = spotify_call(sp_obj.playlist_add_items, playlist_id, items=args)
+    else:
+        range_start, range_length, insert_before = args
+        result = spotify_call(sp_obj.playlist_reorder_items, playlist_id, range_start=range_start,
+                              insert_before=insert_before, range_length=range_length, snapshot_id=snapshot_id)
 
-        offset = 0
-        length = 100
+    metrics.inc('spotify_mutations', op=op)
 
-        while total_prunes > 0:
-            logger.debug('Playlist ({}) [{}]: Pruning playlist'.format('Spotify', playlist_obj.get_spotifyname_id()))
-            sp_obj.playlist_remove_all_occurrences_of_items(playlist_id, items=prune_trackids[offset:offset + length])
-            total_prunes = total_prunes - 100
-            offset = offset + 100
+    return result['snapshot_id']
 
-        logger.info('Playlist ({}) [{}]: Pruned playlist'.format('Spotify', playlist_obj.get_spotifyname_id()))
 
-
-def add_to_playlist(playlist_obj, sp_obj, local_trackids, sp_trackids):
+def sync_steps(playlist_obj, sp_obj, steps, snapshot_id, done=0, dry_run=False):
 
     playlist_id = playlist_obj.get_spotifyid()
-    add_trackids = [x for x in local_trackids if x not in sp_trackids]
 
-    total_additions = len(add_trackids)
+    if dry_run:
+        counts = Counter()
+        for op, args in steps[done:]:
+            counts[op] = counts[op] + (1 if op == 'reorder' else len(args))
+        logger.info('Playlist ({}) [{}]: Planned {} prunes, {} additions and {} reorder moves'.format(
+            'Spotify', playlist_obj.get_spotifyname_id(), counts['prune'], counts['add'], counts['reorder']))
+        return snapshot_id
 
-    if add_trackids:
+    for idx in range(done, len(steps)):
+        op, args = steps[idx]
 
-        offset = 0
-        length = 100
+        logger.debug('Playlist ({}) [{}]: Applying step {} of {} ({})'.format(
+            'Spotify', playlist_obj.get_spotifyname_id(), idx + 1, len(steps), op))
+        with metrics.timer('spotify_playlist_seconds', op=op):
+            snapshot_id = apply_step(sp_obj, playlist_id, op, args, snapshot_id)
+        checkpoint(playlist_id, snapshot_id, idx + 1)
 
-        while total_additions > 0:
-            logger.debug('Playlist ({}) [{}]: Adding tracks to playlist'.format('Spotify',
-                                                                                playlist_obj.get_spotifyname_id()))
-            sp_obj.playlist_add_items(playlist_id, items=add_trackids[offset:offset + length])
-            total_additions = total_additions - 100
-            offset = offset + 100
+        if idx + 1 == len(steps) or steps[idx + 1][0] != op:
+            logger.info('Playlist ({}) [{}]: {}'.format('Spotify', playlist_obj.get_spotifyname_id(), STEP_LOGS[op]))
 
-        logger.info('Playlist ({}) [{}]: Added tracks to playlist'.format('Spotify', playlist_obj.get_spotifyname_id()))
+    return snapshot_id
 
 
-def reorder_playlist(playlist_obj, sp_obj, local_trackids):
+def update_playlist_artwork(playlist_obj, sp_obj):
 
     playlist_id = playlist_obj.get_spotifyid()
-    local_idx = 0
-    reorder_flag = False
-    sp_trackids = get_spotify_playlist_trackids(sp_obj, playlist_obj)
+    playlist_art = playlist_obj.get_artwork()
 
-    if len(sp_trackids) != len(local_trackids):
-        logger.error('Playlist ({}) [{}]: Track number mismatch,'
-                     'reordering failed'.format('Spotify', playlist_obj.get_spotifyname_id()))
-        return
-    elif set(sp_trackids) != set(local_trackids):
-        logger.error('Playlist ({}) [{}]: Tracks mismatch,'
-                     'reordering failed'.format('Spotify', playlist_obj.get_spotifyname_id()))
+    if playlist_art is None:
         return
 
-    for local_trackid in local_trackids:
-        sp_idx = sp_trackids.index(local_trackid)
-        if local_idx != sp_idx:
-            reorder_flag = True
-            sp_obj.playlist_reorder_items(playlist_id, range_start=sp_idx, insert_before=local_idx)
-            sp_trackids = get_spotify_playlist_trackids(sp_obj, playlist_obj)
-        local_idx = local_idx + 1
-
-    if reorder_flag:
-        logger.info('Playlist ({}) [{}]: Reordered playlist'.format('Spotify', playlist_obj.get_spotifyname_id()))
-
-
-def update_playlist_artwork(playlist_obj, sp_obj):
-
-    playlist_id = playlist_obj.get_spotifyid()
-    playlist_art = playlist_obj.get_artwork()
+    source_hash, payload = playlist_art
+    if is_uploaded(playlist_id, source_hash):
+        logger.debug('Playlist ({}) [{}]: Artwork unchanged, upload skipped'.format(
+            'Spotify', playlist_obj.get_spotifyname_id()))
+        metrics.inc('artwork_skipped')
+        return
 
-    if playlist_art is not None:
-        sp_obj.playlist_upload_cover_image(playlist_id, playlist_art)
-        logger.info('Playlist ({}) [{}]: Updated artwork'.format('Spotify', playlist_obj.get_spotifyname_id()))
+    spotify_call(sp_obj.playlist_upload_cover_image, playlist_id, payload)
+    record_upload(playlist_id, source_hash)
+    metrics.inc('spotify_mutations', op='artwork')
+    logger.info('Playlist ({}) [{}]: Updated artwork'.format('Spotify', playlist_obj.get_spotifyname_id()))
 
 
-def process_playlist(df, playlist_link, update_art=False):
+def process_playlist(df, playlist_link, update_art=False, dry_run=False):
 
     current_playlist = get_playlist(playlist_link)
 
-    auth_manager = set_auth(clientflag=True)
-    sp = spotipy.Spotify(client_credentials_manager=auth_manager)
+    sp = get_spotify_client(clientflag=True)
 
     if current_playlist['spotifyid'] != 'NIL':
-        sp_trackids = get_spotify_playlist_trackids(sp, current_playlist)
         local_trackids = get_local_trackids(df)
+        fingerprint = get_fingerprint(local_trackids)
+        snapshot_id = get_spotify_snapshot_id(sp, current_playlist)
 
         logger.info('Playlist ({}) [{}]: Started processing'.format('Spotify', current_playlist.get_spotifyname_id()))
 
-        prune_playlist(current_playlist, sp, local_trackids, sp_trackids)
-        add_to_playlist(current_playlist, sp, local_trackids, sp_trackids)
-        reorder_playlist(current_playlist, sp, local_trackids)
-
-        if update_art:
+        if is_unchanged(current_playlist.get_spotifyid(), fingerprint, snapshot_id):
+            logger.info('Playlist ({}) [{}]: Unchanged since last sync, tracks skipped'.format(
+                'Spotify', current_playlist.get_spotifyname_id()))
+            metrics.inc('playlists_skipped')
+        else:
+            journal = load_journal(current_playlist.get_spotifyid(), fingerprint, snapshot_id)
+
+            if journal is not None:
+                steps, done = journal
+                logger.info('Playlist ({}) [{}]: Resuming after {} of {} steps'.format(
+                    'Spotify', current_playlist.get_spotifyname_id(), done, len(steps)))
+                metrics.inc('playlists_resumed')
+            else:
+                diff = PlaylistDiff(local_trackids, get_spotify_playlist_trackids(sp, current_playlist))
+                steps, done = diff.get_steps(), 0
+                if steps and not dry_run:
+                    start_journal(current_playlist.get_spotifyid(), fingerprint, snapshot_id, steps)
+
+            snapshot_id = sync_steps(current_playlist, sp, steps, snapshot_id, done=done, dry_run=dry_run)
+
+            if not dry_run:
+                record(current_playlist.get_spotifyid(), fingerprint, snapshot_id)
+
+        if update_art and not dry_run:
             logger.debug('SpotiM3U ({}): Update artwork is enabled'.format('Pref'))
             update_playlist_artwork(current_playlist, sp)
 
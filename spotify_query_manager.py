@@ -2,45 +2,54 @@ import logging
 import os
 import re
 import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import spotipy
-import yaml
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
-
+import metrics
+from client_registry import get_client, get_session, load_config
+from match_scoring import is_missing, pick_candidate
 from mbz_utils import get_romanised_name
+from rate_limiter import spotify_limiter
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_WORKERS = 4
+DEFAULT_MARKET = 'from_token'
+MAX_RETRIES = 5
+SEARCH_CANDIDATES = 5
+VERIFY_BATCH_SIZE = 50
+
 
 def set_auth(config_file='config.yaml', clientflag=False):
 
     if os.path.isfile(config_file):
-        with open(config_file, 'r') as fp:
-            auth_dict = yaml.safe_load(fp)
-            try:
-                client_id = auth_dict['spotify_creds']['client_id']
-                client_secret = auth_dict['spotify_creds']['client_secret']
-                redirect_uri = auth_dict['spotify_creds']['redirect_uri']
-
-                if client_id == 'none' or client_secret == 'none':
-                    logger.error(
-                        'SpotiM3U ({}): Edit the config.yaml for SpotiM3U to work'.format('Func'))
-                    sys.exit(1)
-
-                if clientflag:
-                    logger.debug('Auth ({}): Attempting client authorisation'.format('Spotify'))
-                    scope = 'playlist-modify-public playlist-read-collaborative playlist-read-private ' \
-                            'playlist-modify-private ugc-image-upload'
-                    auth_manager = SpotifyOAuth(client_id=client_id, client_secret=client_secret,
-                                                redirect_uri=redirect_uri, scope=scope)
-                else:
-                    logger.debug('Auth ({}): Attempting server-side authorisation'.format('Spotify'))
-                    auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
+        auth_dict = load_config(config_file)
+        try:
+            client_id = auth_dict['spotify_creds']['client_id']
+            client_secret = auth_dict['spotify_creds']['client_secret']
+            redirect_uri = auth_dict['spotify_creds']['redirect_uri']
 
-                return auth_manager
+            if client_id == 'none' or client_secret == 'none':
+                logger.error(
+                    'SpotiM3U ({}): Edit the config.yaml for SpotiM3U to work'.format('Func'))
+                sys.exit(1)
 
-            except (KeyError, TypeError):
-                logger.error('SpotiM3U ({}): Invalid YAML (Spotify)'.format('Func'))
+            from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+
+            if clientflag:
+                logger.debug('Auth ({}): Attempting client authorisation'.format('Spotify'))
+                scope = 'playlist-modify-public playlist-read-collaborative playlist-read-private ' \
+                        'playlist-modify-private ugc-image-upload'
+                auth_manager = SpotifyOAuth(client_id=client_id, client_secret=client_secret,
+                                            redirect_uri=redirect_uri, scope=scope, requests_session=get_session())
+            else:
+                logger.debug('Auth ({}): Attempting server-side authorisation'.format('Spotify'))
+                auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret,
+                                                        requests_session=get_session())
+
+            return auth_manager
+
+        except (KeyError, TypeError):
+            logger.error('SpotiM3U ({}): Invalid YAML (Spotify)'.format('Func'))
 
     else:
         logger.error('SpotiM3U ({}): Creating YAML; edit the config.yaml for SpotiM3U to work'.format('Func'))
@@ -62,6 +71,7 @@ def set_auth(config_file='config.yaml', clientflag=False):
                 }
             }
         }
+        import yaml
         with open(config_file, 'w') as fp:
             yaml.safe_dump(default_dict, fp)
             sys.exit(1)
@@ -69,38 +79,173 @@ def set_auth(config_file='config.yaml', clientflag=False):
     return None
 
 
-def get_spotify_id(title, artist, album):
+def spotify_call(func, *args, **kwargs):
+
+    from spotipy.exceptions import SpotifyException
 
-    auth_manager = set_auth()
-    title = '"' + re.sub(r'\([Ff]eat\.? .+\)', '', title).strip() + '"'
+    for attempt in range(MAX_RETRIES):
+        spotify_limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except SpotifyException as e:
+            # Only a 429 Spotify actually sent carries headers; anything else is not a rate limit
+            if e.http_status != 429 or not e.headers or attempt == MAX_RETRIES - 1:
+                raise
+            retry_after = e.headers.get('Retry-After')
+            spotify_limiter.pause(float(retry_after) if retry_after is not None else 1.0)
+
+
+def create_spotify_client(clientflag=False):
+
+    import spotipy
+
+    auth_manager = set_auth(clientflag=clientflag)
 
     if auth_manager is None:
         logger.error('SpotiM3U ({}): Authorisation failed'.format('Func'))
+        return None
+
+    # Fetched while get_client still holds its lock, so concurrent workers cannot each start the interactive prompt
+    auth_manager.get_access_token(as_dict=False)
+
+    return spotipy.Spotify(auth_manager=auth_manager, requests_session=get_session())
+
+
+def get_spotify_client(clientflag=False):
+    return get_client('spotify-user' if clientflag else 'spotify', lambda: create_spotify_client(clientflag))
+
+
+def get_query_title(title):
+    return '"' + re.sub(r'\([Ff]eat\.? .+\)', '', str(title)).replace('"', '').strip() + '"'
+
+
+def get_field_query(title, artist=None):
+
+    query = 'track:' + get_query_title(title)
+
+    if not is_missing(artist):
+        query = query + ' artist:"{}"'.format(str(artist).replace('"', ''))
+
+    return query
+
+
+def search_spotify_id(sp, query, title, artists, album=None, length=None, alt=False, market=None):
+
+    logger.debug('Query ({}): Querying{} with \'{}\''.format('Spotify', ' (alt)' if alt else '', query))
+    with metrics.timer('spotify_search_seconds', kind='alt' if alt else 'primary'):
+        result = spotify_call(sp.search, q=query, limit=SEARCH_CANDIDATES, market=market)
+
+    try:
+        candidates = result['tracks']['items']
+    except (KeyError, TypeError):
+        candidates = []
+
+    # Playability is only reported with a market; a track verify flagged as unplayable must not be picked again
+    candidates = [x for x in candidates if x and x.get('is_playable') is not False]
+
+    spotifyid = pick_candidate(candidates, title, artists, album=album, length=length)
+
+    metrics.inc('spotify_searches', kind='alt' if alt else 'primary', result='miss' if spotifyid is None else 'hit')
+    return spotifyid
+
+
+def search_spotify_id_primary(sp, title, artist, album, length=None, market=None):
+    return search_spotify_id(sp, get_field_query(title, artist), title, [artist], album=album, length=length,
+                             market=market)
+
+
+def search_spotify_id_alt(sp, title, artist, album, length, romanised_artist, market=None):
+
+    # Without a different romanised name, widen to a title-only search and let the scoring check the artist
+    if is_missing(romanised_artist) or romanised_artist.casefold() == str(artist).casefold():
+        query = get_field_query(title)
     else:
-        sp = spotipy.Spotify(client_credentials_manager=auth_manager)
-        query = '{} {} {}'.format(title, album, artist)
-        logger.debug('Query ({}): Querying with \'{}\''.format('Spotify', query))
-        result = sp.search(q=query, limit=1)
+        query = get_field_query(title, romanised_artist)
 
-        try:
-            return result['tracks']['items'][0]['id']
-        except (KeyError, TypeError, IndexError):
-            try:
-                query = '{} {}'.format(title, get_romanised_name(artist))
-                logger.debug('Query ({}): Querying (alt) with \'{}\''.format('Spotify', query))
-                result = sp.search(q=query, limit=1)
-                return result['tracks']['items'][0]['id']
-            except (KeyError, TypeError, IndexError):
-                logger.warning('Query ({}): Query not found \'{}\''.format('Spotify', query))
-                return 'NOT_AVAIL'
-
-
-def get_spotify_id_nullsafe(title, artist, album, nullflag, force_update=False):
-
-    if nullflag == 'NIL':
-        return get_spotify_id(title, artist, album)
-    elif force_update is True and nullflag == 'NOT_AVAIL':
-        logger.debug('SpotiM3U ({}): Force update is enabled'.format('Pref'))
-        return get_spotify_id(title, artist, album)
-
-    return nullflag
+    spotifyid = search_spotify_id(sp, query, title, [artist, romanised_artist], album=album, length=length, alt=True,
+                                  market=market)
+
+    if spotifyid is None:
+        logger.warning('Query ({}): Query not found \'{}\''.format('Spotify', query))
+        return 'NOT_AVAIL'
+
+    return spotifyid
+
+
+def resolve_spotify_ids(queries, workers=DEFAULT_WORKERS, callback=None, market=None):
+
+    spotifyids = [None] * len(queries)
+
+    # Checked first, so a cache-only run with nothing to search never needs credentials
+    if not queries:
+        return spotifyids
+
+    sp = get_spotify_client(clientflag=market == 'from_token')
+    if sp is None:
+        return spotifyids
+
+    logger.debug('Query ({}): Resolving {} tracks with {} workers'.format('Spotify', len(queries), workers))
+
+    search_primary, romanise, search_alt = [metrics.bind(x) for x in (search_spotify_id_primary, get_romanised_name,
+                                                                      search_spotify_id_alt)]
+
+    # MusicBrainz fallbacks run in their own single-worker lane so they never hold up Spotify searches
+    with ThreadPoolExecutor(max_workers=workers) as spotify_pool, ThreadPoolExecutor(max_workers=1) as mbz_pool:
+
+        pending = {spotify_pool.submit(search_primary, sp, *query, market=market): ('primary', idx)
+                   for idx, query in enumerate(queries)}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, idx = pending.pop(future)
+                title, artist, album, length = queries[idx]
+                result = future.result()
+
+                if stage == 'primary' and result is None:
+                    pending[mbz_pool.submit(romanise, artist)] = ('mbz', idx)
+                elif stage == 'mbz':
+                    pending[spotify_pool.submit(search_alt, sp, title, artist, album, length, result,
+                                                market=market)] = ('alt', idx)
+                else:
+                    spotifyids[idx] = result
+                    if callback is not None:
+                        callback(idx, result)
+
+    return spotifyids
+
+
+def check_spotify_ids(sp, spotifyids, market=DEFAULT_MARKET):
+
+    flagged = {}
+    result = spotify_call(sp.tracks, spotifyids, market=market)
+
+    for spotifyid, track in zip(spotifyids, result['tracks']):
+        if track is None:
+            flagged[spotifyid] = ('missing', None)
+        elif track.get('is_playable') is False:
+            flagged[spotifyid] = ('unplayable', None)
+        elif track.get('linked_from') or track['id'] != spotifyid:
+            flagged[spotifyid] = ('relinked', track['id'])
+
+    return flagged
+
+
+def verify_spotify_ids(spotifyids, workers=DEFAULT_WORKERS, market=DEFAULT_MARKET):
+
+    flagged = {}
+    # Playability and relinking are only reported for a market, and from_token needs the user's token
+    sp = get_spotify_client(clientflag=market == 'from_token')
+
+    if sp is None or not spotifyids:
+        return flagged
+
+    batches = [spotifyids[x:x + VERIFY_BATCH_SIZE] for x in range(0, len(spotifyids), VERIFY_BATCH_SIZE)]
+    logger.debug('Query ({}): Verifying {} tracks in {} batches with {} workers'.format('Spotify', len(spotifyids),
+                                                                                     len(batches), workers))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(metrics.bind(lambda x: check_spotify_ids(sp, x, market=market)), batches):
+            flagged.update(result)
+
+    return flagged
@@ -0,0 +1,70 @@
+import json
+import logging
+from hashlib import md5
+from pathlib import Path
+
+import db_store
+from m3u_reader import stat_playlists
+
+logger = logging.getLogger(__name__)
+
+
+def get_fingerprint(trackids):
+    return md5('\n'.join(trackids).encode()).hexdigest()
+
+
+def is_unchanged(spotifyid, fingerprint, snapshot_id):
+    return db_store.get_sync_state(spotifyid) == {'fingerprint': fingerprint, 'snapshot_id': snapshot_id}
+
+
+def record(spotifyid, fingerprint, snapshot_id):
+
+    logger.debug('Cache ({}): Recording sync state of \'{}\''.format('Local', spotifyid))
+    db_store.upsert_sync_state(spotifyid, fingerprint, snapshot_id)
+    db_store.delete_journal(spotifyid)
+
+
+def get_playlist_files(playlists, settings):
+
+    spotifyids = db_store.get_playlist_spotifyids()
+
+    # Options that change how a playlist is read, and where it syncs to, count as a change as much as the file itself
+    return {path: (mtime_ns, size, get_fingerprint([settings, spotifyids.get(Path(path).stem, 'NIL')]))
+            for path, (mtime_ns, size) in stat_playlists(playlists).items()}
+
+
+def is_library_unchanged(files):
+
+    # An interrupted sync is only resumed by a full run, however unchanged its M3U file looks
+    if db_store.has_journals():
+        return False
+
+    stored = db_store.get_playlist_files()
+
+    return all(stored.get(x) == y for x, y in files.items())
+
+
+def load_journal(spotifyid, fingerprint, snapshot_id):
+
+    journal = db_store.get_journal(spotifyid)
+
+    if journal is None:
+        return None
+
+    # Steps are positional, so they only still apply to the exact playlist state they were checkpointed against
+    if journal['fingerprint'] != fingerprint or journal['snapshot_id'] != snapshot_id:
+        logger.debug('Cache ({}): Discarding stale journal of \'{}\''.format('Local', spotifyid))
+        db_store.delete_journal(spotifyid)
+        return None
+
+    return json.loads(journal['steps']), journal['done']
+
+
+def start_journal(spotifyid, fingerprint, snapshot_id, steps):
+
+    logger.debug('Cache ({}): Journaling {} steps of \'{}\''.format('Local', len(steps), spotifyid))
+    db_store.insert_journal(spotifyid, fingerprint, snapshot_id, json.dumps(steps))
+
+
+def checkpoint(spotifyid, snapshot_id, done):
+    db_store.update_journal(spotifyid, snapshot_id, done)
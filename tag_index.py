@@ -0,0 +1,122 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import RLock
+
+import db_store
+import metrics
+from dicttypes import read_tags
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCAN_WORKERS = 8
+
+_lock = RLock()
+_index = None
+_dirty = set()
+
+
+def get_stat_key(path):
+
+    resolved = os.path.realpath(path)
+    stat = os.stat(resolved)
+
+    return resolved, stat.st_mtime_ns, stat.st_size
+
+
+def load_index():
+
+    global _index
+
+    with _lock:
+        if _index is None:
+            logger.debug('Cache ({}): Reading tag index'.format('Local'))
+            _index = db_store.load_tags()
+
+        return _index
+
+
+def parse_tags(path):
+
+    import mutagen
+
+    return read_tags(mutagen.File(path))
+
+
+def try_parse_tags(path):
+
+    try:
+        return parse_tags(path)
+    except Exception as e:
+        logger.debug('Cache ({}): Could not parse \'{}\': {}'.format('Local', path, e))
+        return None
+
+
+@metrics.timed('phase_seconds', phase='scan')
+def scan_tags(paths, workers=DEFAULT_SCAN_WORKERS, processes=False):
+
+    index = load_index()
+    found = {}
+    pending = {}
+
+    for path in dict.fromkeys(paths):
+        try:
+            resolved, mtime_ns, size = get_stat_key(path)
+        except OSError:
+            continue
+        entry = index.get(resolved)
+        if entry is None or entry[0] != mtime_ns or entry[1] != size:
+            pending.setdefault(resolved, (mtime_ns, size, []))[2].append(path)
+        else:
+            found[path] = entry[2]
+
+    metrics.inc('tag_cache', sum(len(x[2]) for x in pending.values()), result='miss')
+    metrics.inc('tag_cache', len(found), result='hit')
+
+    if not pending:
+        return found
+
+    logger.debug('Cache ({}): Parsing tags of {} files with {} {}'.format(
+        'Local', len(pending), workers, 'processes' if processes else 'threads'))
+
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(max_workers=workers) as pool:
+        for (resolved, (mtime_ns, size, originals)), tags in zip(pending.items(),
+                                                                 pool.map(try_parse_tags, pending, chunksize=64)):
+            # Unreadable files are left out, so the error surfaces in the local stage of the playlist listing them
+            if tags is None:
+                continue
+            with _lock:
+                index[resolved] = (mtime_ns, size, tags)
+                _dirty.add(resolved)
+            found.update(dict.fromkeys(originals, tags))
+
+    return found
+
+
+def get_tags(path):
+
+    resolved, mtime_ns, size = get_stat_key(path)
+    entry = load_index().get(resolved)
+
+    if entry is not None and entry[0] == mtime_ns and entry[1] == size:
+        return entry[2]
+
+    logger.debug('Cache ({}): Parsing tags of \'{}\''.format('Local', resolved))
+    tags = parse_tags(resolved)
+    with _lock:
+        load_index()[resolved] = (mtime_ns, size, tags)
+        _dirty.add(resolved)
+
+    return tags
+
+
+def save_index():
+
+    with _lock:
+        if not _dirty:
+            return
+
+        logger.debug('Cache ({}): Writing {} tag index entries'.format('Local', len(_dirty)))
+        db_store.upsert_tags({path: load_index()[path] for path in _dirty})
+        _dirty.clear()
@@ -0,0 +1,38 @@
+import logging
+from collections import Counter
+
+import db_store
+import metrics
+import resolution_cache
+from spotify_query_manager import DEFAULT_MARKET, DEFAULT_WORKERS, verify_spotify_ids
+
+logger = logging.getLogger(__name__)
+
+
+@metrics.timed('phase_seconds', phase='verify')
+def verify_library(workers=DEFAULT_WORKERS, market=DEFAULT_MARKET):
+
+    spotifyids = db_store.get_stored_spotifyids()
+
+    logger.info('Verify ({}): Checking {} stored track IDs'.format('Spotify', len(spotifyids)))
+    flagged = verify_spotify_ids(spotifyids, workers=workers, market=market)
+
+    statuses = Counter(status for status, _ in flagged.values())
+    metrics.inc('verified_tracks', len(spotifyids) - len(flagged), status='ok')
+    for status, count in statuses.items():
+        metrics.inc('verified_tracks', count, status=status)
+
+    for spotifyid, (status, new_spotifyid) in sorted(flagged.items()):
+        logger.debug('Verify ({}): {} is {}{}'.format('Spotify', spotifyid, status,
+                                                      ' as ' + new_spotifyid if new_spotifyid else ''))
+
+    if flagged:
+        # Relinked IDs are swapped in directly; missing and unplayable ones go back to NIL to be searched again
+        replacements = {spotifyid: new_spotifyid for spotifyid, (_, new_spotifyid) in flagged.items()}
+        resolution_cache.replace_ids(replacements)
+        db_store.replace_playlist_spotifyids(replacements)
+
+    logger.info('Verify ({}): {} missing, {} unplayable, {} relinked'.format(
+        'Spotify', statuses['missing'], statuses['unplayable'], statuses['relinked']))
+
+    return flagged